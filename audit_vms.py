@@ -6,89 +6,349 @@ Look for VMs that have been running for several hours on an Orka cluster,
 which is suspicious when used as Gitlab CI runners.
 
 Additionally, it can delete those "ghost" VMs.
+
+Uptime limits can depend on VMs tags or base images, when defined in a JSON file passed with --limits-file, e.g.:
+    {"tags": {"xcode": 6, "builder": 24}, "base_images": {"*xcode*": 6}}
+A tag limit prevails over a base image one, matched as a glob pattern, & --list-running-for-hours applies to the VMs matching none.
+
+With --watch, it runs as a daemon auditing VMs periodically,
+and exposes the results as Prometheus metrics.
+
+With --snapshot, the VMs deployed are saved in a file, so that the VMs created, deleted, redeployed or moved since the previous audit are reported,
+and only them with --changes-only, e.g. for monitoring jobs run every minute.
 '''
 
 # USAGE example: ./audit_vms.py --list-running-for-hours 6
+#                ./audit_vms.py --list-running-for-hours 6 --delete-ghost-vms --concurrency 8 --max-delete-rate 2
+#                ./audit_vms.py --list-running-for-hours 6 --watch 60 --metrics-port 9877
+#                ./audit_vms.py --limits-file limits.json --list-running-for-hours 48
 # Orka API reference: https://documenter.getpostman.com/view/6574930/S1ETRGzt
 
-import argparse, math, sys, re
+import argparse, json, sys, re, threading, time
+from collections import Counter, namedtuple
 from datetime import datetime
+from fnmatch import translate
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from commons import add_common_opts_and_parse_args, add_output_opts, check_http_status, orka_session, run_concurrently, snapshot_module, ArgparseHelpFormatter, RowsWriter
 
-from commons import add_common_opts_and_parse_args, check_http_status, orka_session, ArgparseHelpFormatter
+
+NODE_NAME_REGEX = re.compile('(?:x86-)?(macpro-|m2-mini-)(.*)')
 
 
 def main(argv):
     args = parse_args(argv)
-    ghost_vms_ids = []
-    print(" All the times are in UTC timezone")
-    print("//-------------------------//")
-    present = datetime.utcnow()
-    nb_vm_by_tag = {}
     with orka_session(**vars(args)) as session:
-        resp = check_http_status(session.get('/resources/vm/list/all'))
-        # Iterate on each vm sorted by virtual_machine_name
-        for vm in sorted(resp.json()['virtual_machine_resources'], key=lambda vm: vm['virtual_machine_name']):
-            if vm['vm_deployment_status'] == 'Not Deployed':
-                print(vm["virtual_machine_name"].ljust(22), ':', vm['vm_deployment_status'].ljust(14), " | owner : ", vm['owner'])
-                continue
-            print(vm["virtual_machine_name"].ljust(22), ':', vm['vm_deployment_status'].ljust(14), " | owner : ", vm['status'][0]['owner'])
-            for cpt, status in enumerate (vm['status']):
-                # For better alignment
-                node_number = re.sub('(?:x86-)?(macpro-|m2-mini-)(.*)', '\\2', status["node_location"])
-                nodename = re.sub('(?:x86-)?(macpro-|m2-mini-)(.*)', '\\1', status["node_location"]) + node_number[-2:].zfill(2)
-                cpt = str(cpt+1).zfill(2)
-                # Display usefull information
-                print(f'\t {cpt} | {status["virtual_machine_id"]} │ {nodename} | {status["virtual_machine_ip"]} │ cpu={status["cpu"]}/{status["vcpu"]} │ {status["RAM"]} │ {status["vm_status"]} │ {status["creation_timestamp"]} │ {status["base_image"]} | {status["tag"]} | {status["tag_required"]}')
-                vm_creation_date = datetime.strptime(status['creation_timestamp'], '%Y-%m-%dT%H:%M:%SZ')
-                vm_uptime_in_days = (present - vm_creation_date).days
-                vm_uptime_in_hours = math.floor((present - vm_creation_date).seconds / 3600)
-                vm_total_uptime_in_hours = (vm_uptime_in_days*24)+vm_uptime_in_hours
-                if args.list_running_for_hours and vm_total_uptime_in_hours >= args.list_running_for_hours:
-                    ghost_vms_ids.append((status['virtual_machine_id'], vm_uptime_in_days, vm_uptime_in_hours))
-                nb_vm_by_tag[status["tag"]] = nb_vm_by_tag.get(status["tag"], 0) + 1
+        if args.watch:
+            watch(args, session)
+            return
+        vms, changes = list_vms_changes(session, args.snapshot) if args.snapshot else (list_vms(session), None)
+        audit = audit_vms(vms, datetime.utcnow(), args.limits)
+        # With a machine-readable output format, only VMs or their changes are written on stdout:
+        log = sys.stdout if args.output == 'table' else sys.stderr
+        if changes and not args.changes_only:  # Reported before the audit, as they are not reported again by the next one:
+            print(f'Changes since the previous audit: {len(changes)}', file=log)
+            snapshot_module().write_changes(changes, out=log)
+            print(file=log)
+        if args.changes_only:
+            snapshot_module().write_changes(changes, args.output, args.fields)
+        elif args.output == 'table':
+            print(" All the times are in UTC timezone")
+            print("//-------------------------//")
+            print_vms(vms)
             print()
-        print()
-        print("Number of VMs by tag:")
-        for tag, nb_vm in nb_vm_by_tag.items():
-            print(f'    {tag} : {nb_vm}')
-        print()
-        if ghost_vms_ids:
-            print(f'"ghost" VMs detected, running for at least {args.list_running_for_hours} hours:')
-            print('\n'.join(f'{vm_id} - uptime: {uptime_in_days}d and {uptime_in_hours:.1f}h' for vm_id, uptime_in_days, uptime_in_hours in ghost_vms_ids))
+            print("Number of VMs by tag:")
+            for tag, nb_vm in audit.nb_vm_by_tag.items():
+                print(f'    {tag} : {nb_vm}')
+            print()
+        else:
+            write_vms_rows(args, vms, audit)
+        if audit.ghost_vms:
+            print('"ghost" VMs detected, running for at least their uptime limit:', file=log)
+            print('\n'.join(f'{vm_id} - uptime: {uptime / 3600:.1f}h, limit: {limit_in_hours}h' for vm_id, uptime, limit_in_hours in audit.ghost_vms), file=log)
             if args.delete_ghost_vms:
-                print('You are about to delete all those VMs.')
-                if not (args.force_delete or ask_for_confirmation()):
-                    print('Aborting')
+                print('You are about to delete all those VMs.', file=log)
+                if not (args.force_delete or ask_for_confirmation(log)):
+                    print('Aborting', file=log)
                     return
-                for ghost_vm_id, _, _ in ghost_vms_ids:
-                    print('Deleting:', ghost_vm_id)
-                    resp = check_http_status(session.delete('/resources/vm/delete',
-                                             json={"orka_vm_name": ghost_vm_id}))
-                    print(resp.json())
+                if delete_vms(session, [ghost_vm_id for ghost_vm_id, _, _ in audit.ghost_vms], args.concurrency, args.max_delete_rate, log):
+                    sys.exit(1)
             else:
                 sys.exit(2)
 
 
-def ask_for_confirmation():
-    print('Please confirm (y/n): ', end='')
+def list_vms(session):
+    'Return all VMs sorted by virtual_machine_name'
+    resp = check_http_status(session.get('/resources/vm/list/all'))
+    return sorted(resp.json()['virtual_machine_resources'], key=lambda vm: vm['virtual_machine_name'])
+
+
+def list_vms_changes(session, snapshot_filename):
+    '''
+    Return all VMs sorted by virtual_machine_name, along with the changes since the snapshot saved in snapshot_filename,
+    which is then updated. Changes are not computed if the VMs list response is the same as the one of the snapshot
+    '''
+    resp = check_http_status(session.get('/resources/vm/list/all'))
+    vms = sorted(resp.json()['virtual_machine_resources'], key=lambda vm: vm['virtual_machine_name'])
+    return vms, snapshot_module().snapshot_changes(resp, snapshot_filename, vms)
+
+
+def print_vms(vms):
+    for vm in vms:
+        if vm['vm_deployment_status'] == 'Not Deployed':
+            print(vm["virtual_machine_name"].ljust(22), ':', vm['vm_deployment_status'].ljust(14), " | owner : ", vm['owner'])
+            continue
+        print(vm["virtual_machine_name"].ljust(22), ':', vm['vm_deployment_status'].ljust(14), " | owner : ", vm['status'][0]['owner'])
+        for cpt, status in enumerate (vm['status']):
+            nodename = short_node_name(status["node_location"])
+            cpt = str(cpt+1).zfill(2)
+            # Display usefull information
+            print(f'\t {cpt} | {status["virtual_machine_id"]} │ {nodename} | {status["virtual_machine_ip"]} │ cpu={status["cpu"]}/{status["vcpu"]} │ {status["RAM"]} │ {status["vm_status"]} │ {status["creation_timestamp"]} │ {status["base_image"]} | {status["tag"]} | {status["tag_required"]}')
+        print()
+
+
+@lru_cache(maxsize=None)
+def short_node_name(node_location):
+    'For better alignment, the node name prefix followed by its last 2 characters, e.g. macpro-7 -> macpro-07'
+    match = NODE_NAME_REGEX.search(node_location)
+    if not match:
+        return node_location + node_location[-2:].zfill(2)
+    prefix = node_location[:match.start()]
+    return prefix + match[1] + (prefix + match[2])[-2:].zfill(2)
+
+
+def write_vms_rows(args, vms, audit):
+    'Write a row per deployed VM instance, with its uptime & uptime limit, then a row per VM not deployed'
+    uptimes = {vm_id: uptime for _, vm_id, _, uptime in audit.uptimes}
+    ghost_vms_ids = {vm_id for vm_id, _, _ in audit.ghost_vms}
+    with RowsWriter(args.output, args.fields) as writer:
+        for vm in vms:
+            for status in vm.get('status', ()) if vm['vm_deployment_status'] != 'Not Deployed' else ():
+                writer.write({'virtual_machine_name': vm['virtual_machine_name'], 'vm_deployment_status': vm['vm_deployment_status'], **status,
+                              'uptime_in_hours': round(uptimes[status['virtual_machine_id']] / 3600, 2),
+                              'ghost': status['virtual_machine_id'] in ghost_vms_ids,
+                              'uptime_limit_in_hours': args.limits.get(status['tag'], status['base_image'])})
+        for vm in vms:
+            if vm['vm_deployment_status'] == 'Not Deployed':
+                writer.write(vm)
+
+
+Audit = namedtuple('Audit', ('nb_vm_by_tag', 'nb_vm_by_deployment_status', 'uptimes', 'ghost_vms'))
+# Compact record of a deployed VM instance, holding only the fields audited:
+VmInstance = namedtuple('VmInstance', ('vm_name', 'vm_id', 'node', 'tag', 'base_image', 'creation_timestamp'))
+
+
+def audit_vms(vms, present, limits=None):
+    '''
+    Compute the number of VM instances by tag, the number of VMs by deployment status,
+    the uptime in seconds of each VM instance as (vm_name, vm_id, node, uptime) tuples,
+    and the VM instances running for at least their UptimeLimits as (vm_id, uptime, limit_in_hours) tuples
+    '''
+    instances = parse_vm_instances(vms)
+    uptimes = compute_uptimes([instance.creation_timestamp for instance in instances], present)
+    ghost_vms = []
+    if limits:
+        for instance, uptime in zip(instances, uptimes):
+            limit_in_hours = limits.get(instance.tag, instance.base_image)
+            if limit_in_hours is not None and uptime >= limit_in_hours * 3600:
+                ghost_vms.append((instance.vm_id, uptime, limit_in_hours))
+    return Audit(Counter(instance.tag for instance in instances), Counter(vm['vm_deployment_status'] for vm in vms),
+                 [(instance.vm_name, instance.vm_id, instance.node, uptime) for instance, uptime in zip(instances, uptimes)], ghost_vms)
+
+
+def parse_vm_instances(vms):
+    'Return a VmInstance per deployed VM instance'
+    return [VmInstance(vm['virtual_machine_name'], status['virtual_machine_id'], status['node_location'], status['tag'], status['base_image'],
+                       status['creation_timestamp'])
+            for vm in vms if vm['vm_deployment_status'] != 'Not Deployed' for status in vm['status']]
+
+
+def compute_uptimes(creation_timestamps, present):
+    '''
+    Return the uptimes in seconds matching creation timestamps like 2021-05-20T14:02:51Z.
+    Timestamps are parsed once each, with datetime.fromisoformat, much faster than strptime
+    '''
+    creation_dates = {timestamp: datetime.fromisoformat(timestamp.rstrip('Z')) for timestamp in set(creation_timestamps)}
+    return [(present - creation_dates[timestamp]).total_seconds() for timestamp in creation_timestamps]
+
+
+class UptimeLimits:
+    '''
+    Uptime limits in hours of VM instances, by tag & by base image glob pattern, with a default limit for the other VMs.
+    Limits are only resolved once per distinct (tag, base image) pair.
+    '''
+    def __init__(self, default=None, tags=None, base_images=None):
+        self.default = default
+        self.tags = tags or {}
+        self.base_images = [(re.compile(translate(pattern)), limit_in_hours) for pattern, limit_in_hours in (base_images or {}).items()]
+        self.cache = {}
+
+    @classmethod
+    def load(cls, limits_filename, default=None):
+        'Load limits from a JSON file like {"tags": {"xcode": 6}, "base_images": {"*-builder.img": 24}}'
+        with open(limits_filename, encoding='utf-8') as limits_file:
+            limits = json.load(limits_file)
+        return cls(default, limits.get('tags'), limits.get('base_images'))
+
+    def __bool__(self):
+        return bool(self.default or self.tags or self.base_images)
+
+    def get(self, tag, base_image):
+        limit_in_hours = self.cache.get((tag, base_image), self)
+        if limit_in_hours is self:
+            limit_in_hours = self.cache[tag, base_image] = self._resolve(tag, base_image)
+        return limit_in_hours
+
+    def _resolve(self, tag, base_image):
+        if tag in self.tags:
+            return self.tags[tag]
+        for regex, limit_in_hours in self.base_images:
+            if regex.match(base_image or ''):
+                return limit_in_hours
+        return self.default
+
+
+def watch(args, session):
+    '''
+    Audit VMs every args.watch seconds, reusing the same session,
+    exposing the results as Prometheus metrics & optionally deleting ghost VMs
+    '''
+    metrics_server = MetricsServer((args.metrics_address, args.metrics_port), MetricsHandler)
+    threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    print(f'Serving Prometheus metrics on http://{args.metrics_address}:{args.metrics_port}/metrics, auditing VMs every {args.watch}s')
+    counters = {'audits': 0, 'audit_errors': 0, 'ghost_vms_deleted': 0, 'ghost_vms_deletion_errors': 0}
+    last_success = 0
+    metrics_server.metrics = format_metrics(None, counters, last_success).encode('utf-8')
+    while True:
+        start = time.monotonic()
+        audit = None
+        try:
+            vms, changes = list_vms_changes(session, args.snapshot) if args.snapshot else (list_vms(session), None)
+            audit = audit_vms(vms, datetime.utcnow(), args.limits)
+            counters['audits'] += 1
+            last_success = time.time()
+            print(f'{datetime.utcnow():%Y-%m-%d %H:%M:%S} - {len(audit.uptimes)} VM instances, {len(audit.ghost_vms)} ghost VMs', flush=True)
+            if changes:
+                snapshot_module().write_changes(changes)
+            if audit.ghost_vms and args.delete_ghost_vms:
+                ghost_vms_ids = [ghost_vm_id for ghost_vm_id, _, _ in audit.ghost_vms]
+                failed_vms_ids = delete_vms(session, ghost_vms_ids, args.concurrency, args.max_delete_rate)
+                counters['ghost_vms_deleted'] += len(ghost_vms_ids) - len(failed_vms_ids)
+                counters['ghost_vms_deletion_errors'] += len(failed_vms_ids)
+        except Exception as error:  # pylint: disable=broad-except
+            # The daemon keeps running whatever the error, e.g. the controller being unreachable or the snapshot file unwritable:
+            counters['audit_errors'] += 1
+            print(f'{datetime.utcnow():%Y-%m-%d %H:%M:%S} - Audit failed: {error}', flush=True)
+        # Metrics are rendered after each cycle, even a failed one, so that VM gauges of a stale audit are not served anymore:
+        metrics_server.metrics = format_metrics(audit, counters, last_success).encode('utf-8')
+        time.sleep(max(0, args.watch - (time.monotonic() - start)))
+
+
+def format_metrics(audit, counters, timestamp):
+    '''
+    Render an audit with the Prometheus text exposition format, along with counters since startup & the time of the last successful audit.
+    VM gauges are omitted if audit is None, i.e. before the first audit or after a failed one
+    '''
+    lines = []
+    def metric(name, metric_type, help_text, samples):
+        lines.extend((f'# HELP orka_{name} {help_text}', f'# TYPE orka_{name} {metric_type}'))
+        for labels, value in samples:
+            labels = ','.join(f'{label}="{escape_label(label_value)}"' for label, label_value in labels.items())
+            lines.append(f'orka_{name}{{{labels}}} {value}' if labels else f'orka_{name} {value}')
+    if audit is not None:
+        metric('vms_by_tag', 'gauge', 'Number of deployed VM instances by tag',
+               (({'tag': tag}, nb_vm) for tag, nb_vm in audit.nb_vm_by_tag.items()))
+        metric('vms_by_deployment_status', 'gauge', 'Number of VMs by deployment status',
+               (({'deployment_status': status}, nb_vm) for status, nb_vm in audit.nb_vm_by_deployment_status.items()))
+        metric('vm_uptime_seconds', 'gauge', 'Uptime of each deployed VM instance',
+               (({'vm_name': vm_name, 'vm_id': vm_id, 'node': node}, uptime) for vm_name, vm_id, node, uptime in audit.uptimes))
+        metric('ghost_vms', 'gauge', 'Number of VM instances running for longer than their uptime limit',
+               [({}, len(audit.ghost_vms))])
+    metric('audit_last_success_timestamp_seconds', 'gauge', 'Time of the last successful audit, 0 if none yet', [({}, timestamp)])
+    for name, value in counters.items():
+        metric(f'{name}_total', 'counter', f'Number of {name.replace("_", " ")} since startup', [({}, value)])
+    return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsServer(ThreadingHTTPServer):
+    metrics = b''
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(self.server.metrics)))
+        self.end_headers()
+        self.wfile.write(self.server.metrics)
+
+    def log_message(self, *_):  # pylint: disable=arguments-differ
+        pass
+
+
+def delete_vms(session, vms_ids, concurrency, max_rate=None, out=None):
+    start = time.monotonic()
+    failed_vms_ids = []
+    print(f'Deleting {len(vms_ids)} VMs, {concurrency} at a time' + (f', at most {max_rate} per second' if max_rate else ''), file=out)
+    for vm_id, resp, error, duration in run_concurrently(
+            lambda vm_id: check_http_status(session.delete('/resources/vm/delete', json={"orka_vm_name": vm_id})),
+            vms_ids, concurrency, max_rate):
+        if error:
+            failed_vms_ids.append(vm_id)
+            print(f'Failed to delete {vm_id} after {duration:.1f}s: {error}', file=out)
+        else:
+            print(f'Deleted {vm_id} in {duration:.1f}s:', resp.json(), file=out)
+    print(f'{len(vms_ids) - len(failed_vms_ids)}/{len(vms_ids)} VMs deleted in {time.monotonic() - start:.1f}s', file=out)
+    if failed_vms_ids:
+        print('Failed deletions:', ' '.join(failed_vms_ids), file=out)
+    return failed_vms_ids
+
+
+def ask_for_confirmation(out=None):
+    print('Please confirm (y/n): ', end='', file=out, flush=True)
     while True:
         choice = input().lower()
         if choice in ('yes', 'y'):
             return True
         if choice in ('no', 'n'):
             return False
-        print("Please respond with 'yes' or 'no': ", end='')
+        print("Please respond with 'yes' or 'no': ", end='', file=out, flush=True)
 
 
 def parse_args(argv=None):
     parser = argparse.ArgumentParser(formatter_class=ArgparseHelpFormatter,
                                      description=__doc__, allow_abbrev=False)
     parser.add_argument('--list-running-for-hours', type=float, help='List VMs running for at least X hours')
-    parser.add_argument('--delete-ghost-vms', action='store_true', help='Require --list-running-for-hours')
+    parser.add_argument('--limits-file', help='JSON file of uptime limits in hours by VM tag & base image, cf. above. '
+                                              '--list-running-for-hours then applies to the other VMs')
+    parser.add_argument('--delete-ghost-vms', action='store_true', help='Require --list-running-for-hours or --limits-file')
     parser.add_argument('--force-delete', default=False, action='store_true', help='Bypass interactive confirmation')
+    parser.add_argument('--concurrency', type=int, default=4, help='Max number of VMs deleted at the same time')
+    parser.add_argument('--max-delete-rate', type=float, help='Max number of VM deletion requests per second')
+    parser.add_argument('--snapshot', help='File where the VMs deployed are saved, to report the changes since the previous audit')
+    parser.add_argument('--changes-only', action='store_true',
+                        help='Only list the VMs created, deleted, redeployed or moved to another node since the previous audit, '
+                             'instead of all VMs. Requires --snapshot')
+    parser.add_argument('--watch', type=float, metavar='INTERVAL', help='Audit VMs every INTERVAL seconds & expose Prometheus metrics')
+    parser.add_argument('--metrics-address', default='127.0.0.1', help='Listening address of the Prometheus metrics endpoint in --watch mode')
+    parser.add_argument('--metrics-port', type=int, default=9877, help='Listening port of the Prometheus metrics endpoint in --watch mode')
+    add_output_opts(parser)
     args = add_common_opts_and_parse_args(parser, argv)
-    if args.delete_ghost_vms and not args.list_running_for_hours:
-        parser.error('--delete-ghost-vms require --list-running-for-hours')
+    args.limits = UptimeLimits.load(args.limits_file, args.list_running_for_hours) if args.limits_file else UptimeLimits(args.list_running_for_hours)
+    if args.delete_ghost_vms and not args.limits:
+        parser.error('--delete-ghost-vms require --list-running-for-hours or --limits-file')
+    if args.changes_only and not args.snapshot:
+        parser.error('--changes-only requires --snapshot')
+    if args.watch and args.delete_ghost_vms and not args.force_delete:
+        parser.error('--watch with --delete-ghost-vms requires --force-delete')
     return args
 
 
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+End-to-end benchmark of the scripts of this repository, run against mock_orka_controller.py.
+
+Each scenario, i.e. a script & its arguments, is run several times in a subprocess,
+and its median wall time, its number of HTTP requests & its peak RSS are reported.
+Results can be saved as JSON with --save, and compared to previously saved results with --compare:
+the exit code is then non-zero if a scenario got slower than --tolerance, or sent more requests,
+or if the output of a scenario not depending on the current date changed, e.g. logs_stats.py counts, for the same dataset.
+
+Peak RSS measurement relies on os.wait4, and is only available on Unix.
+'''
+
+# USAGE: ./benchmark.py --vms 5000 --logs 1000000 --save baseline.json
+#        ./benchmark.py --vms 5000 --logs 1000000 --compare baseline.json
+#        ./benchmark.py --only 'orka.py*' --latency .05
+
+import argparse, hashlib, json, os, statistics, subprocess, sys, tempfile, time
+from fnmatch import fnmatch
+from urllib.request import urlopen
+
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+# (name, command line, stdin content), {tmp} being replaced by a temporary directory shared by all scenarios.
+# Scenarios are run in this order, e.g. so that logs are dumped before being analysed:
+SCENARIOS = (
+    ('orka.py vm list', ['orka.py', 'vm', 'list'], None),
+    ('orka.py vm list -o ndjson', ['orka.py', '-o', 'ndjson', 'vm', 'list'], None),
+    ('orka.py vm list --changes-only', ['orka.py', 'vm', 'list', '--snapshot', '{tmp}/snapshot.json', '--changes-only'], None),
+    ('orka.py vm get id', ['orka.py', 'vm', 'get', 'id', '--vm', 'runner-0'], None),
+    ('orka.py image list', ['orka.py', 'image', 'list'], None),
+    ('orka.py node list', ['orka.py', 'node', 'list'], None),
+    ('orka.py node status --all', ['orka.py', 'node', 'status', '--all'], None),
+    ('orka.py node capacity', ['orka.py', 'node', 'capacity'], None),
+    ('orka.py user list', ['orka.py', 'user', 'list'], None),
+    ('orka.py batch', ['orka.py', 'batch', '--parallel', '4'], ''.join(f'vm status --vm runner-{i}\n' for i in range(20))),
+    ('audit_vms.py', ['audit_vms.py', '--list-running-for-hours', '48'], None),
+    ('audit_vms.py -o ndjson', ['audit_vms.py', '--list-running-for-hours', '48', '-o', 'ndjson'], None),
+    ('dump_logs.py', ['dump_logs.py', '--out-file', '{tmp}/logs.json'], None),
+    ('dump_logs.py --format jsonl --page-size 10000', ['dump_logs.py', '--format', 'jsonl', '--page-size', '10000', '--out-file', '{tmp}/logs.jsonl.gz'], None),
+    ('dump_logs.py --format sqlite', ['dump_logs.py', '--format', 'sqlite', '--out-file', '{tmp}/logs.db'], None),
+    ('dump_logs.py --format columns', ['dump_logs.py', '--format', 'columns', '--out-file', '{tmp}/logs.cols'], None),
+    ('logs_stats.py', ['logs_stats.py', '--logs-filename', '{tmp}/logs.json'], None),
+    ('logs_stats.py jsonl.gz', ['logs_stats.py', '--logs-filename', '{tmp}/logs.jsonl.gz'], None),
+    ('logs_stats.py sqlite', ['logs_stats.py', '--logs-filename', '{tmp}/logs.db'], None),
+    ('logs_stats.py columns', ['logs_stats.py', '--logs-filename', '{tmp}/logs.cols'], None),
+    # Custom target messages overlapping the built-in ones, which must not change their counts:
+    ('logs_stats.py --target-message', ['logs_stats.py', '--logs-filename', '{tmp}/logs.json',
+                                        '--target-message', 'Requested .* not available', '--target-message', 'Successfully'], None),
+    ('logs_stats.py sqlite --trends hour', ['logs_stats.py', '--logs-filename', '{tmp}/logs.db', '--trends', 'hour', '-o', 'csv'], None),
+    ('logs_stats.py sqlite --for-vm', ['logs_stats.py', '--logs-filename', '{tmp}/logs.db', '--for-vm', 'runner-1'], None),
+)
+
+# Scenarios whose output only depends on the dataset, & not on the current date, so that it can be compared between runs:
+OUTPUT_CHECKED_SCENARIOS = ('logs_stats.py', 'logs_stats.py jsonl.gz', 'logs_stats.py sqlite', 'logs_stats.py columns', 'logs_stats.py --target-message')
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix='orka-benchmark-') as tmp_dir:
+        controller = start_controller(args)
+        try:
+            env = dict(os.environ, ORKA_CONTROLLER_URL=controller.url, ORKA_LICENSE_KEY='benchmark', ORKA_USER_EMAIL='user@example.com',
+                       ORKA_PASSWORD='benchmark', ORKA_TOKEN_CACHE=os.path.join(tmp_dir, 'tokens.json'), ORKA_CACHE_TTL='0')
+            results = {}
+            print(f"{'Scenario':<48} │ Wall time │ Requests │ Peak RSS │ Exit code")
+            for name, cmd_line, stdin in SCENARIOS:
+                if args.only and not any(fnmatch(name, pattern) for pattern in args.only):
+                    continue
+                results[name] = run_scenario(controller, [arg.format(tmp=tmp_dir) for arg in cmd_line], stdin, env, args.runs)
+                result = results[name]
+                print(f"{name:<48} | {result['wall_time']:>8.3f}s | {result['requests']:>8} | {result['peak_rss_kb'] / 1024:>6.1f}MB | {result['exit_code']}", flush=True)
+        finally:
+            controller.terminate()
+            controller.wait()
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as results_file:
+            json.dump({'dataset': dataset_opts(args), 'results': results}, results_file, indent=4)
+    if args.compare:
+        regressions = compare(args.compare, results, args.tolerance, dataset_opts(args))
+        if regressions:
+            print('\n'.join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+def start_controller(args):
+    cmd_line = [sys.executable, os.path.join(SCRIPTS_DIR, 'mock_orka_controller.py'), '--port', '0', '--user-email', 'user@example.com']
+    for opt, value in dataset_opts(args).items():
+        cmd_line += [f"--{opt.replace('_', '-')}", str(value)]
+    controller = subprocess.Popen(cmd_line, stdout=subprocess.PIPE, universal_newlines=True)  # pylint: disable=consider-using-with
+    controller.url = controller.stdout.readline().split()[-1]  # The first line is "Listening on {url}"
+    return controller
+
+
+def dataset_opts(args):
+    return {'vms': args.vms, 'nodes': args.nodes, 'logs': args.logs, 'latency': args.latency, 'error_rate': args.error_rate}
+
+
+def run_scenario(controller, cmd_line, stdin, env, runs):
+    '''
+    Run a script several times, and return its median wall time, its number of requests & its peak RSS over all runs,
+    along with the digest of its output
+    '''
+    wall_times, requests_counts, peak_rss_kb, exit_code, output_digest = [], [], 0, 0, None
+    for _ in range(runs):
+        # A login is performed at each run, so that requests counts do not depend on the previous runs:
+        if os.path.exists(env['ORKA_TOKEN_CACHE']):
+            os.remove(env['ORKA_TOKEN_CACHE'])
+        requests_count = get_requests_count(controller)
+        start = time.perf_counter()
+        # The output is written to a file rather than a pipe, so that it does not need to be read before os.wait4 returns:
+        with tempfile.TemporaryFile() as output, \
+                subprocess.Popen([sys.executable, os.path.join(SCRIPTS_DIR, cmd_line[0]), *cmd_line[1:]], env=env, universal_newlines=True,
+                                 stdin=subprocess.PIPE, stdout=output, stderr=subprocess.DEVNULL) as process:
+            if stdin:
+                process.stdin.write(stdin)
+            process.stdin.close()
+            # Unlike Popen.wait, os.wait4 provides the resources used by this very process:
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            output.seek(0)
+            output_digest = hashlib.sha256(output.read()).hexdigest()
+        wall_times.append(time.perf_counter() - start)
+        requests_counts.append(get_requests_count(controller) - requests_count)
+        # ru_maxrss is in kilobytes on Linux, but in bytes on macOS:
+        peak_rss_kb = max(peak_rss_kb, rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss)
+        exit_code = exit_code or process.returncode
+    return {'wall_time': statistics.median(wall_times), 'requests': max(requests_counts), 'peak_rss_kb': peak_rss_kb, 'exit_code': exit_code,
+            'output_digest': output_digest}
+
+
+def get_requests_count(controller):
+    with urlopen(controller.url + '/_stats') as resp:
+        return json.load(resp)['requests']
+
+
+def compare(baseline_filename, results, tolerance, dataset):
+    'Return the list of regressions compared to the results saved in baseline_filename'
+    with open(baseline_filename, encoding='utf-8') as baseline_file:
+        saved = json.load(baseline_file)
+    baseline, same_dataset = saved['results'], saved['dataset'] == dataset
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result['wall_time'] > expected['wall_time'] * (1 + tolerance):
+            regressions.append(f"{name}: wall time {result['wall_time']:.3f}s > {expected['wall_time']:.3f}s")
+        if result['requests'] > expected['requests']:
+            regressions.append(f"{name}: {result['requests']} requests > {expected['requests']}")
+        if result['peak_rss_kb'] > expected['peak_rss_kb'] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {result['peak_rss_kb'] / 1024:.1f}MB > {expected['peak_rss_kb'] / 1024:.1f}MB")
+        if same_dataset and name in OUTPUT_CHECKED_SCENARIOS and expected.get('output_digest') not in (None, result['output_digest']):
+            regressions.append(f"{name}: output changed")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__, allow_abbrev=False)
+    parser.add_argument('--runs', type=int, default=3, help='Number of runs of each scenario')
+    parser.add_argument('--only', action='append', help='Only run the scenarios matching this glob pattern. Can be repeated')
+    parser.add_argument('--vms', type=int, default=500, help='Number of VMs of the mock controller')
+    parser.add_argument('--nodes', type=int, default=50, help='Number of nodes of the mock controller')
+    parser.add_argument('--logs', type=int, default=100000, help='Number of logs of the mock controller')
+    parser.add_argument('--latency', type=float, default=0, help='Delay in seconds before the mock controller answers each request')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of the requests answered by the mock controller with a 500 error')
+    parser.add_argument('--save', help='JSON file where to save results')
+    parser.add_argument('--compare', help='JSON file of previously saved results, to compare to')
+    parser.add_argument('--tolerance', type=float, default=.2, help='Relative increase of wall time & peak RSS considered as a regression')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
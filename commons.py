@@ -3,10 +3,12 @@
 
 # Orka API reference: https://documenter.getpostman.com/view/6574930/S1ETRGzt
 
-import argparse, os
+import argparse, base64, contextvars, csv, glob, hashlib, importlib, json, os, sys, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
 from getpass import getpass
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit
 
 import requests
 from requests.adapters import HTTPAdapter
@@ -14,37 +16,90 @@ from urllib3.util.retry import Retry
 
 
 USER_AGENT = "voyages-sncf-technologies/orka-tools/orka.py"
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'orka-tools')
+DEFAULT_TOKEN_CACHE = os.path.join(CACHE_DIR, 'tokens.json')
+DEFAULT_RESPONSES_CACHE_DIR = os.path.join(CACHE_DIR, 'responses')
 
 
 @contextmanager
-def orka_session(orka_controller, user_email, password, license_key, retries=3, backoff_factor=.3, **_):
-    'Setup a session with retry adapters, perform login and configure HTTP auth headers'
+def orka_session(orka_controller, user_email, password, license_key, retries=3, backoff_factor=.3, token_cache=None, concurrency=10,
+                 cache_ttl=0, cache_dir=None, cache_max_entries=256, trace=None, **_):
+    """
+    Setup a session with retry adapters, perform login and configure HTTP auth headers.
+    If token_cache is a file path, a bearer token previously stored there for this controller & user is reused,
+    and a new login is only performed when the Orka controller answers with a 401.
+    The session can be shared by up to `concurrency` threads without opening extra connections.
+    If cache_ttl is non-zero, successful GET responses are cached for this number of seconds, cf. ResponseCache.
+    Whatever cache_ttl, write requests invalidate the responses cached in cache_dir by other processes.
+    If trace is provided, requests are traced, and a summary is printed at the end of the session if trace is "1" or "-",
+    or they are written to trace as a JSON file, cf. commons_trace.py
+    """
     session = SessionWithPrefixUrl(orka_controller)
-    adapter = HTTPAdapter(max_retries=Retry(total=retries, read=retries, connect=retries, backoff_factor=backoff_factor))
+    if cache_ttl or (cache_dir and os.path.isdir(cache_dir)):
+        session.response_cache = ResponseCache(cache_ttl, cache_max_entries, cache_dir)
+    adapter_class, retry_class = HTTPAdapter, Retry
+    if trace:
+        # Lazily imported, as tracing is only enabled on demand:
+        from commons_trace import HttpTracer, TracedRetry, TracingHTTPAdapter  # pylint: disable=import-outside-toplevel
+        session.tracer = HttpTracer()
+        adapter_class, retry_class = TracingHTTPAdapter, TracedRetry
+    adapter = adapter_class(pool_maxsize=max(concurrency, 10),
+                            max_retries=retry_class(total=retries, read=retries, connect=retries, backoff_factor=backoff_factor))
     session.mount('http://', adapter)
     session.mount('https://', adapter)
-    resp = check_http_status(session.post('/token', data={
-        'email': user_email,
-        'password': password,
-    }))
-    # print('Token 1 : ' + resp.json()['token'])
-    # session.headers.update({
-    #     'User-Agent': "UA test token",
-    # })
-    # resp = check_http_status(session.post('/token', data={
-    #     'email': user_email,
-    #     'password': password,
-    # }))
-    # print('Token 2 : ' + resp.json()['token'])
     session.headers.update({
-        'Authorization': 'Bearer ' + resp.json()['token'],
         'orka-licensekey': license_key,
         'User-Agent': USER_AGENT,
     })
-    # resp = check_http_status(session.get('/token'))
-    # print('Token Get : ' + resp.text)
-    yield session
-    #check_http_status(session.delete('/token'))
+    cache_key = f'{orka_controller}|{user_email}'
+    def login(session):
+        resp = check_http_status(session.post('/token', data={
+            'email': user_email,
+            'password': password,
+        }))
+        token = resp.json()['token']
+        if token_cache:
+            store_cached_token(token_cache, cache_key, token)
+        session.headers['Authorization'] = 'Bearer ' + token
+    try:
+        token = token_cache and load_cached_token(token_cache, cache_key)
+        if token:
+            session.headers['Authorization'] = 'Bearer ' + token
+        else:
+            login(session)
+        session.on_unauthorized = login
+        yield session
+    finally:
+        if session.tracer:
+            session.tracer.report(trace)
+
+
+def load_cached_token(token_cache, cache_key):
+    try:
+        with open(token_cache, encoding='utf-8') as cache_file:
+            return json.load(cache_file).get(cache_key)
+    except (OSError, ValueError):
+        return None
+
+
+def store_cached_token(token_cache, cache_key, token):
+    'Atomically rewrite the tokens cache file, making it readable by its owner only'
+    try:
+        with open(token_cache, encoding='utf-8') as cache_file:
+            tokens = json.load(cache_file)
+    except (OSError, ValueError):
+        tokens = {}
+    tokens[cache_key] = token
+    write_private_json_file(token_cache, tokens)
+
+
+def write_private_json_file(path, data):
+    'Atomically write a JSON file readable by its owner only, creating its parent directory if needed'
+    os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as json_file:
+        json.dump(data, json_file)
+    os.replace(tmp_path, path)
 
 
 def check_http_status(response):
@@ -59,17 +114,244 @@ class SessionWithPrefixUrl(requests.Session):
     # Recipe from: https://github.com/psf/requests/issues/2554#issuecomment-109341010
     def __init__(self, prefix_url):
         self.prefix_url = prefix_url
+        # Optional callback re-authenticating the session, invoked at most once per request on a 401:
+        self.on_unauthorized = None
+        self.response_cache = None
+        self.tracer = None
+        self._auth_lock = threading.Lock()
+        self._thread_state = threading.local()
         super().__init__()
 
     def request(self, method, url, *args, **kwargs):
+        if self.tracer:
+            return self.tracer.trace(self._cached_request, method, url, *args, **kwargs)
+        return self._cached_request(method, url, *args, **kwargs)
+
+    def _cached_request(self, method, url, *args, **kwargs):
         url = urljoin(self.prefix_url, url)
-        return super().request(method, url, *args, **kwargs)
+        cacheable = self.response_cache and self.response_cache.ttl and method.upper() == 'GET' and not kwargs.get('stream') \
+                    and 'no-cache' not in (kwargs.get('headers') or {}).get('Cache-Control', '')
+        if cacheable:
+            cache_key = (url, json.dumps(kwargs.get('params'), sort_keys=True), self.headers.get('Authorization'))
+            response = self.response_cache.get(cache_key)
+            if response:
+                return response
+        response = self._request(method, url, *args, **kwargs)
+        if cacheable and response.status_code == 200:
+            self.response_cache.set(cache_key, response)
+        elif self.response_cache and method.upper() != 'GET':
+            self.response_cache.invalidate(url)
+        return response
+
+    def _request(self, method, url, *args, **kwargs):
+        authorization = self.headers.get('Authorization')
+        response = super().request(method, url, *args, **kwargs)
+        if response.status_code == 401 and self.on_unauthorized and not getattr(self._thread_state, 'authenticating', False):
+            with self._auth_lock:
+                # Only re-authenticate if no other thread did it in the meantime:
+                if self.headers.get('Authorization') == authorization:
+                    self._thread_state.authenticating = True
+                    try:
+                        self.on_unauthorized(self)
+                    finally:
+                        self._thread_state.authenticating = False
+            response = super().request(method, url, *args, **kwargs)
+        return response
+
+
+class ResponseCache:
+    '''
+    TTL cache of HTTP responses, bounded to max_entries by evicting the oldest entries first,
+    kept in memory and, if cache_dir is provided, in this directory so that it is shared between processes.
+    Entries are grouped by Orka resource type (vm, image, node...), so that a write request on a resource invalidates them.
+    With a zero ttl, nothing is cached, but write requests still invalidate the entries of cache_dir.
+    '''
+    # Deploying or deleting VMs changes the nodes available resources:
+    RELATED_RESOURCES = {'vm': ('vm', 'node')}
+
+    def __init__(self, ttl, max_entries=256, cache_dir=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def resource_of(url):
+        path = urlsplit(url).path.strip('/').split('/')
+        return path[1] if path[0] == 'resources' and len(path) > 1 else path[0]
+
+    def _entry_name(self, key):
+        return f'{self.resource_of(key[0])}-' + hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        name = self._entry_name(key)
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is None and self.cache_dir:
+            try:
+                with open(os.path.join(self.cache_dir, name + '.json'), encoding='utf-8') as entry_file:
+                    entry = json.load(entry_file)
+            except (OSError, ValueError):
+                return None
+        if entry is None or entry['expires'] < time.time():
+            return None
+        response = requests.Response()
+        response.status_code = entry['status_code']
+        response.headers.update(entry['headers'])
+        response.url = entry['url']
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = base64.b64decode(entry['content'])  # pylint: disable=protected-access
+        return response
+
+    def set(self, key, response):
+        name = self._entry_name(key)
+        entry = {
+            'expires': time.time() + self.ttl,
+            'status_code': response.status_code,
+            'headers': dict(response.headers),
+            'url': response.url,
+            'content': base64.b64encode(response.content).decode('ascii'),
+        }
+        with self.lock:
+            self.entries[name] = entry
+            self.entries.move_to_end(name)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if self.cache_dir:
+            write_private_json_file(os.path.join(self.cache_dir, name + '.json'), entry)
+            entry_paths = glob.glob(os.path.join(self.cache_dir, '*.json'))
+            if len(entry_paths) > self.max_entries:
+                for entry_path in sorted(entry_paths, key=os.path.getmtime)[:len(entry_paths) - self.max_entries]:
+                    remove_file(entry_path)
+
+    def invalidate(self, url):
+        resource = self.resource_of(url)
+        for prefix in self.RELATED_RESOURCES.get(resource, (resource,)):
+            with self.lock:
+                for name in [name for name in self.entries if name.startswith(prefix + '-')]:
+                    del self.entries[name]
+            if self.cache_dir:
+                for entry_path in glob.glob(os.path.join(self.cache_dir, glob.escape(prefix) + '-*.json')):
+                    remove_file(entry_path)
+
+
+def remove_file(path):
+    'Remove a file, if it has not already been removed by a concurrent process'
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def run_concurrently(func, targets, concurrency, max_rate=None):
+    '''
+    Call func on each target through a pool of threads, at most max_rate times per second if provided,
+    yielding (target, result, exception, duration in seconds) tuples as they complete
+    '''
+    rate_limiter = RateLimiter(max_rate) if max_rate else None
+    def timed_call(target):
+        if rate_limiter:
+            rate_limiter.wait()
+        start = time.monotonic()
+        try:
+            return func(target), None, time.monotonic() - start
+        except Exception as error:  # pylint: disable=broad-except
+            return None, error, time.monotonic() - start
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Each call runs in a copy of the caller context, so that context variables like the output capture of orka.py batch are inherited:
+        futures = {executor.submit(contextvars.copy_context().run, timed_call, target): target for target in targets}
+        for future in as_completed(futures):
+            yield (futures[future], *future.result())
+
+
+class RateLimiter:  # pylint: disable=too-few-public-methods
+    'Thread-safe limiter, spacing out wait() returns so that they happen at most `rate` times per second'
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_until = max(self.next_time, now)
+            self.next_time = wait_until + self.interval
+        time.sleep(wait_until - now)
+
+
+class RowsWriter:
+    '''
+    Write rows, i.e. flat dicts, as soon as they are provided, in a machine-readable format:
+    as a JSON array, as newline-delimited JSON or as CSV, where list & dict values are JSON-encoded.
+    If fields are provided, only those are kept.
+    '''
+    def __init__(self, output_format, fields=None, out=None):
+        self.output_format = output_format
+        self.fields = fields
+        self.out = out or sys.stdout
+        self.csv_writer = None
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        if self.output_format == 'json':
+            self.out.write('\n]\n' if self.count else '[]\n')
+
+    def write(self, row):
+        if self.fields:
+            row = {field: row.get(field) for field in self.fields}
+        if self.output_format == 'csv':
+            if not self.csv_writer:
+                self.csv_writer = csv.DictWriter(self.out, fieldnames=list(row), extrasaction='ignore')
+                self.csv_writer.writeheader()
+            # Lists & dicts are JSON-encoded, so that they can be parsed back:
+            self.csv_writer.writerow({field: json.dumps(value) if isinstance(value, (list, dict)) else value for field, value in row.items()})
+        elif self.output_format == 'ndjson':
+            self.out.write(json.dumps(row) + '\n')
+        else:
+            self.out.write(('[\n' if not self.count else ',\n') + json.dumps(row))
+        self.count += 1
+
+
+def add_output_opts(parser):
+    parser.add_argument('--output', '-o', choices=('table', 'json', 'ndjson', 'csv'), default='table',
+                        help='Output format of listings: a human-readable table, or a machine-readable format')
+    parser.add_argument('--fields', type=lambda fields: fields.split(','),
+                        help='Comma-separated list of the fields to output, with a machine-readable --output format')
+
+
+def snapshot_module():
+    'Return commons_snapshot, lazily imported as snapshots are only used on demand'
+    return importlib.import_module('commons_snapshot')
+
+
+def trace_from_env(value):
+    'Interpret $ORKA_TRACE: 1 prints a summary on stderr, i.e. --trace, unset, empty, 0 or false values disable tracing, & others are trace files'
+    if not value or value.lower() in ('0', 'false', 'no', 'off'):
+        return None
+    return '-' if value == '1' else value
 
 
 def add_common_opts_and_parse_args(parser, argv=None):
     parser.add_argument('--orka-controller', help='Default to $ORKA_CONTROLLER_URL')
     parser.add_argument('--license-key', help='Default to $ORKA_LICENSE_KEY')
     parser.add_argument('--user-email', help='Default to $ORKA_USER_EMAIL')
+    parser.add_argument('--token-cache', default=os.environ.get('ORKA_TOKEN_CACHE') or DEFAULT_TOKEN_CACHE,
+                        help='File where Orka bearer tokens are cached between calls, overridable with $ORKA_TOKEN_CACHE')
+    parser.add_argument('--no-token-cache', dest='token_cache', action='store_const', const=None, help='Always perform a login')
+    parser.add_argument('--cache-ttl', type=float, default=float(os.environ.get('ORKA_CACHE_TTL') or 0),
+                        help='Cache successful GET responses for this number of seconds, overridable with $ORKA_CACHE_TTL')
+    parser.add_argument('--cache-dir', default=os.environ.get('ORKA_CACHE_DIR') or DEFAULT_RESPONSES_CACHE_DIR,
+                        help='Directory where responses are cached, shared between processes, overridable with $ORKA_CACHE_DIR. '
+                             'Use an empty string to only cache them in memory')
+    parser.add_argument('--cache-max-entries', type=int, default=256, help='Max number of cached responses')
+    parser.add_argument('--trace', action='store_const', const='-', default=trace_from_env(os.environ.get('ORKA_TRACE')),
+                        help='Trace HTTP requests, printing a summary of their count, retries, size & latency by endpoint on stderr at exit. '
+                             'Enabled if $ORKA_TRACE is set to 1, or to the path of a trace file')
+    parser.add_argument('--trace-file', dest='trace', help='Trace HTTP requests, writing them with their summary to this JSON file')
     args = parser.parse_args(argv)
     if not args.orka_controller:
         args.orka_controller = os.environ.get('ORKA_CONTROLLER_URL')
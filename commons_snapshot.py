@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Snapshots of the VM instances of an Orka cluster, saved on disk between runs,
+so that only the changes since the previous run can be reported: VMs created, deleted, redeployed or moved to another node.
+'''
+
+import hashlib, json, os, sys
+from collections import defaultdict
+
+from commons import RowsWriter
+
+
+class VmsSnapshot:
+    'Deployed VM instances, as {vm_id: [vm_name, node]}, along with the digest of the /resources/vm/list/all response they come from'
+    def __init__(self, digest=None, instances=None):
+        self.digest = digest
+        self.instances = instances or {}
+
+    @classmethod
+    def load(cls, snapshot_filename):
+        'Return the snapshot saved in this file, or an empty one if it does not exist yet'
+        try:
+            with open(snapshot_filename, encoding='utf-8') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except FileNotFoundError:
+            return cls()
+        return cls(snapshot['digest'], snapshot['instances'])
+
+    @classmethod
+    def from_vms(cls, digest, vms):
+        return cls(digest, {status['virtual_machine_id']: [vm['virtual_machine_name'], status['node_location']]
+                            for vm in vms if vm.get('vm_deployment_status') != 'Not Deployed' for status in vm.get('status') or ()})
+
+    def save(self, snapshot_filename):
+        tmp_filename = snapshot_filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf-8') as snapshot_file:
+            json.dump({'digest': self.digest, 'instances': self.instances}, snapshot_file)
+        os.replace(tmp_filename, snapshot_filename)
+
+    def diff(self, new):
+        '''
+        Return the changes from this snapshot to the new one, sorted by VM name, as rows with a change kind:
+        * created: a new VM instance
+        * deleted: a VM instance gone
+        * redeployed: a VM instance gone & replaced by a new instance of the same VM, on the same node
+        * moved: the same, but on another node
+        '''
+        changes = []
+        gone_by_name = defaultdict(list)
+        for vm_id, (vm_name, node) in sorted(self.instances.items()):
+            if vm_id not in new.instances:
+                gone_by_name[vm_name].append((vm_id, node))
+            elif new.instances[vm_id][1] != node:
+                changes.append(change_row('moved', new.instances[vm_id][0], vm_id, new.instances[vm_id][1], (vm_id, node)))
+        for vm_id, (vm_name, node) in sorted(new.instances.items()):
+            if vm_id in self.instances:
+                continue
+            if gone_by_name[vm_name]:
+                previous = gone_by_name[vm_name].pop(0)
+                changes.append(change_row('moved' if node != previous[1] else 'redeployed', vm_name, vm_id, node, previous))
+            else:
+                changes.append(change_row('created', vm_name, vm_id, node))
+        for vm_name, gone in gone_by_name.items():
+            changes.extend(change_row('deleted', vm_name, vm_id, node) for vm_id, node in gone)
+        return sorted(changes, key=lambda change: change['virtual_machine_name'])
+
+
+def change_row(change, vm_name, vm_id, node, previous=(None, None)):
+    'previous is the (vm_id, node) of the VM instance replaced, if any'
+    return {'change': change, 'virtual_machine_name': vm_name, 'virtual_machine_id': vm_id, 'node': node,
+            'previous_virtual_machine_id': previous[0], 'previous_node': previous[1]}
+
+
+def response_digest(resp):
+    'Digest of a response body, so that an unchanged VMs list can be detected without decoding it'
+    return hashlib.sha256(resp.content).hexdigest()
+
+
+def snapshot_changes(resp, snapshot_filename, vms=None):
+    '''
+    Return the changes since the snapshot saved in snapshot_filename, which is then updated with the VMs of this
+    /resources/vm/list/all response. They are not computed if the response is the same as the one of the snapshot
+    '''
+    previous_snapshot, digest = VmsSnapshot.load(snapshot_filename), response_digest(resp)
+    if digest == previous_snapshot.digest:
+        return []
+    snapshot = VmsSnapshot.from_vms(digest, resp.json()['virtual_machine_resources'] if vms is None else vms)
+    snapshot.save(snapshot_filename)
+    return previous_snapshot.diff(snapshot)
+
+
+def write_changes(changes, output='table', fields=None, out=None):
+    if output != 'table':
+        with RowsWriter(output, fields, out) as writer:
+            for change in changes:
+                writer.write(change)
+        return
+    for change in changes:
+        line = f"{change['change']:<10} {change['virtual_machine_name']} {change['virtual_machine_id']} on {change['node']}"
+        if change['previous_virtual_machine_id']:
+            line += f" (previously {change['previous_virtual_machine_id']} on {change['previous_node']})"
+        print(line, file=out or sys.stdout)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Opt-in tracing of the HTTP requests sent to the Orka API, enabled with --trace, --trace-file or $ORKA_TRACE.
+
+The latency of each request is split into:
+* connect: DNS resolution & TCP connection, when a new connection is opened
+* tls: TLS handshake, when a new HTTPS connection is opened
+* backoff: sleeps between retries
+* server: from the request being sent to the response headers being received, i.e. mostly the controller processing time
+* other: downloading the response body & client overhead.
+  The body of a streamed response is downloaded as the caller reads it, so its request is only recorded once the body
+  is exhausted or the response closed, and this time includes the processing of the body by the caller meanwhile
+
+The time of a request sent while another one is being sent, i.e. a re-login on a 401, is only counted for the former.
+'''
+
+import json, re, sys, threading, time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+
+TIMINGS = ('connect', 'tls', 'backoff', 'server', 'other')
+# Resource names in URL paths are replaced, so that requests are grouped by endpoint:
+ENDPOINT_NAMES = ((re.compile(r'/status/[^/]+$'), '/status/{name}'), (re.compile(r'^/users/.+$'), '/users/{email}'))
+_local = threading.local()
+
+
+class HttpTracer:
+    'Record the requests of a session, to report their count, status, retries, size & latency breakdown by endpoint'
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.records = []
+        # Completion callbacks of the streamed responses whose body has not been entirely read yet:
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def trace(self, send_request, method, url, *args, **kwargs):
+        'Call send_request(method, url, *args, **kwargs), recording how long each step took'
+        timings = dict.fromkeys(TIMINGS, 0.)
+        timings['retries'], timings['nested'] = 0, 0.
+        # A stack, as a request can trigger another one, e.g. a login:
+        _local.timings_stack = getattr(_local, 'timings_stack', []) + [timings]
+        start = time.perf_counter()
+        response, error = None, None
+        try:
+            response = send_request(method, url, *args, **kwargs)
+            return response
+        except Exception as exception:
+            error = exception
+            raise
+        finally:
+            end = time.perf_counter()
+            _local.timings_stack = _local.timings_stack[:-1]
+            if _local.timings_stack:
+                _local.timings_stack[-1]['nested'] += end - start
+            request = {'method': method, 'url': url, 'stream': kwargs.get('stream'), 'start': start, 'end': end,
+                       'total': end - start - timings.pop('nested')}
+            self.record(request, response, error, timings)
+
+    def record(self, request, response, error, timings):
+        raw = response is not None and response.raw
+        retries = timings.pop('retries')
+        total = request['total']
+        if response is not None and raw:
+            timings['server'] = max(0., response.elapsed.total_seconds() - timings['connect'] - timings['tls'] - timings['backoff'])
+        timings['other'] = max(0., total - timings['connect'] - timings['tls'] - timings['backoff'] - timings['server'])
+        body = response.request.body if response is not None and response.request else None
+        record = {
+            'method': request['method'].upper(),
+            'path': urlsplit(request['url']).path,
+            'status': response.status_code if response is not None else None,
+            'error': repr(error) if error else None,
+            'cached': response is not None and not raw,
+            'retries': retries,
+            'bytes_sent': len(body.encode('utf-8') if isinstance(body, str) else body or b''),
+            'bytes_received': len(response.content) if response is not None and not request['stream'] else 0,
+            'start': round(request['start'] - self.start, 6),
+            'total': round(total, 6),
+            **{step: round(duration, 6) for step, duration in timings.items()},
+        }
+        if raw and request['stream']:
+            self.record_on_body_end(response, record, request['end'])
+            return
+        with self.lock:
+            self.records.append(record)
+
+    def record_on_body_end(self, response, record, headers_end):
+        'Count the bytes of a streamed response body as it is read, and record its request once the body is exhausted or the response closed'
+        raw, stream, close = response.raw, response.raw.stream, response.close
+        def complete():
+            with self.lock:
+                if complete not in self.pending:
+                    return
+                self.pending.remove(complete)
+                body_time = time.perf_counter() - headers_end
+                record['total'] = round(record['total'] + body_time, 6)
+                record['other'] = round(record['other'] + body_time, 6)
+                self.records.append(record)
+        def counting_stream(*args, **kwargs):
+            for chunk in stream(*args, **kwargs):
+                record['bytes_received'] += len(chunk)
+                yield chunk
+            complete()
+        def closing_response():
+            complete()
+            close()
+        with self.lock:
+            self.pending.append(complete)
+        raw.stream, response.close = counting_stream, closing_response
+
+    def report(self, trace):
+        'Print a summary by endpoint on stderr, or write all the requests & this summary to the JSON file trace'
+        # Streamed responses never read nor closed are recorded as they are:
+        for complete in list(self.pending):
+            complete()
+        with self.lock:
+            records = list(self.records)
+        endpoints = summarize(records)
+        if trace not in ('1', '-'):
+            with open(trace, 'w', encoding='utf-8') as trace_file:
+                json.dump({'requests': records, 'endpoints': endpoints}, trace_file, indent=4)
+            return
+        print(f"HTTP trace: {len(records)} requests in {sum(record['total'] for record in records):.3f}s, "
+              f"{sum(record['retries'] for record in records)} retries, {sum(record['bytes_received'] for record in records) / 1024:.1f}kB received",
+              file=sys.stderr)
+        columns = ('count', 'errors', 'cached', 'retries', 'total', 'max', *TIMINGS, 'kB')
+        width = max([8] + [len(endpoint['endpoint']) for endpoint in endpoints])
+        print(f"{'Endpoint':<{width}} │ " + ' │ '.join(f'{column:>7}' for column in columns), file=sys.stderr)
+        for endpoint in endpoints:
+            values = [endpoint['count'], endpoint['errors'], endpoint['cached'], endpoint['retries'], f"{endpoint['total']:.3f}", f"{endpoint['max']:.3f}",
+                      *(f'{endpoint[step]:.3f}' for step in TIMINGS), f"{endpoint['bytes_received'] / 1024:.1f}"]
+            print(f"{endpoint['endpoint']:<{width}} | " + ' | '.join(f'{value:>7}' for value in values), file=sys.stderr)
+
+
+def summarize(records):
+    'Aggregate requests by endpoint, from the one where the most time was spent to the least'
+    endpoints = {}
+    for record in records:
+        name = record['path']
+        for regex, replacement in ENDPOINT_NAMES:
+            name = regex.sub(replacement, name)
+        endpoint = endpoints.setdefault(f"{record['method']} {name}", {
+            'endpoint': f"{record['method']} {name}", 'count': 0, 'errors': 0, 'cached': 0, 'retries': 0, 'bytes_received': 0, 'total': 0., 'max': 0.,
+            **dict.fromkeys(TIMINGS, 0.)})
+        endpoint['count'] += 1
+        endpoint['errors'] += bool(record['error']) or record['status'] >= 400
+        endpoint['cached'] += record['cached']
+        endpoint['retries'] += record['retries']
+        endpoint['bytes_received'] += record['bytes_received']
+        endpoint['max'] = max(endpoint['max'], record['total'])
+        for step in ('total', *TIMINGS):
+            endpoint[step] += record[step]
+    return sorted(endpoints.values(), key=lambda endpoint: endpoint['total'], reverse=True)
+
+
+@contextmanager
+def timing(step):
+    'Add the duration of the block to the timings of the request being traced in this thread, if any'
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings_stack = getattr(_local, 'timings_stack', None)
+        if timings_stack:
+            timings_stack[-1][step] += time.perf_counter() - start
+
+
+class TracedRetry(Retry):
+    def sleep(self, response=None):
+        # Called before each retry, even without backoff:
+        with timing('backoff'):
+            super().sleep(response)
+        timings_stack = getattr(_local, 'timings_stack', None)
+        if timings_stack:
+            timings_stack[-1]['retries'] += 1
+
+
+class TracedHTTPConnection(HTTPConnection):
+    def _new_conn(self):
+        with timing('connect'):
+            return super()._new_conn()
+
+
+class TracedHTTPSConnection(HTTPSConnection):
+    # pylint: disable=no-member
+    def _new_conn(self):
+        with timing('connect'):
+            return super()._new_conn()
+
+    def connect(self):
+        # Opening an HTTPS connection opens a TCP connection, timed by _new_conn, then performs the TLS handshake:
+        timings = (getattr(_local, 'timings_stack', None) or [None])[-1]
+        connect_before = timings['connect'] if timings else 0
+        with timing('tls'):
+            super().connect()
+        if timings:
+            timings['tls'] -= timings['connect'] - connect_before
+
+
+class TracedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TracedHTTPConnection
+
+
+class TracedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TracedHTTPSConnection
+
+
+class TracingHTTPAdapter(HTTPAdapter):
+    'HTTP adapter whose connections report how long it took to open them'
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TracedHTTPConnectionPool, 'https': TracedHTTPSConnectionPool}
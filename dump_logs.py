@@ -4,29 +4,185 @@
 '''
 Retrieve all Orka logs from a cluster and dump them into a large JSON file.
 It takes a few minutes to complete.
+
+Logs are streamed from the Orka controller to the output file one record at a time,
+so that memory usage stays flat whatever the number of logs in the cluster.
+The output is gzip-compressed if the output filename ends with .gz.
+With --format sqlite, logs are inserted into an indexed SQLite logs store, cf. logs_db.py
+With --format columns, only the fields analysed by logs_stats.py are written into a compact columnar file, cf. logs_columns.py
+
+With --incremental, the newest log timestamp dumped is saved in a state file,
+and following runs only append newer logs to the output file.
 '''
 
 # USAGE: time ./dump_logs.py
+#        ./dump_logs.py --format jsonl --out-file logs.jsonl.gz --page-size 10000
+#        ./dump_logs.py --format jsonl --out-file logs.jsonl --page-size 1000 --incremental  # e.g. hourly
+#        ./dump_logs.py --format columns --out-file logs.cols
 # Orka API reference: https://documenter.getpostman.com/view/6574930/S1ETRGzt
 
-import argparse, json, sys
+import argparse, codecs, gzip, hashlib, json, os, sys
+from contextlib import closing, nullcontext
 
+import logs_columns, logs_db
 from commons import add_common_opts_and_parse_args, check_http_status, orka_session
+from logs_reader import iter_json_array
 
 
 def main(argv):
     args = parse_args(argv)
-    with orka_session(**vars(args)) as session:
-        resp = check_http_status(session.post('/logs/query'))
-        with open(args.out_file, 'w', encoding='utf-8') as logs_file:
-            json.dump(resp.json(), logs_file, indent=4)
+    previous_watermark = Watermark.load(args.state_file) if args.incremental else None
+    with orka_session(**vars(args)) as session, open_output(args.out_file, args.format, append=args.incremental) as out_file:
+        logs = iter_logs(session, args.page_size, is_known=previous_watermark and previous_watermark.is_known)
+        if args.incremental:
+            watermark = Watermark(previous_watermark.created_at, previous_watermark.digests)
+            logs = watermark.track(logs)
+        count = write_logs(logs, out_file, args.format)
+    if args.incremental:
+        watermark.save(args.state_file)
+    print(f'{count} logs dumped', file=sys.stderr)
+
+
+def iter_logs(session, page_size=0, is_known=None, chunk_size=64*1024):
+    '''
+    Yield Orka logs one by one, incrementally decoding the HTTP response bodies.
+    If page_size is non-zero, logs are retrieved through several /logs/query requests of at most this size.
+    If is_known is provided, logs for which it returns True are skipped,
+    and no more pages are requested once a full page of known logs sorted from newest to oldest is met.
+    '''
+    start = 0
+    # With logs sorted from newest to oldest, the ones created during the dump shift the following pages,
+    # whose first logs were then already yielded: they are skipped, along with the logs created meanwhile, newer than the first page,
+    # by keeping the oldest date yielded & the digests of the logs of this date
+    boundary_date, boundary_digests = None, set()
+    while True:
+        params = {'limit': page_size, 'start': start} if page_size else None
+        resp = check_http_status(session.post('/logs/query', params=params, stream=True))
+        with resp:
+            count, all_known, first_date, last_date, last_logs = 0, True, None, None, []
+            for log in iter_json_array(codecs.iterdecode(resp.iter_content(chunk_size), 'utf-8'), 'logs'):
+                count += 1
+                if log['createdAt'] != last_date:
+                    last_logs = []
+                first_date, last_date = first_date or log['createdAt'], log['createdAt']
+                last_logs.append(log)
+                if boundary_date and (last_date > boundary_date or (last_date == boundary_date and log_digest(log) in boundary_digests)):
+                    continue
+                if is_known and is_known(log):
+                    continue
+                all_known = False
+                yield log
+        # Stop on the last page, or if the controller ignored the pagination parameters:
+        if not page_size or count != page_size:
+            return
+        if first_date > last_date:
+            # Following pages only contain older logs:
+            if is_known and all_known:
+                return
+            if last_date != boundary_date:
+                boundary_date, boundary_digests = last_date, set()
+            boundary_digests.update(log_digest(log) for log in last_logs)
+        start += count
+
+
+class Watermark:
+    'Newest log timestamp already dumped, along with the digests of the logs sharing this exact timestamp'
+    def __init__(self, created_at='', digests=()):
+        self.created_at = created_at
+        self.digests = set(digests)
+
+    @classmethod
+    def load(cls, state_filename):
+        try:
+            with open(state_filename, encoding='utf-8') as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return cls()
+        return cls(state['createdAt'], state['digests'])
+
+    def save(self, state_filename):
+        tmp_filename = state_filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf-8') as state_file:
+            json.dump({'createdAt': self.created_at, 'digests': sorted(self.digests)}, state_file)
+        os.replace(tmp_filename, state_filename)
+
+    def is_known(self, log):
+        if log['createdAt'] != self.created_at:
+            return log['createdAt'] < self.created_at
+        return log_digest(log) in self.digests
+
+    def track(self, logs):
+        'Pass logs through, while moving the watermark forward'
+        for log in logs:
+            if log['createdAt'] > self.created_at:
+                self.created_at, self.digests = log['createdAt'], set()
+            if log['createdAt'] == self.created_at:
+                self.digests.add(log_digest(log))
+            yield log
+
+
+def log_digest(log):
+    return hashlib.sha1(json.dumps(log, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def write_logs(logs, out_file, out_format):
+    'Write logs as they come, either as JSON Lines, as a {"logs": [...]} JSON document with one log per line, or into a SQLite logs store'
+    if out_format == 'sqlite':
+        return logs_db.insert_logs(out_file, logs)
+    if out_format == 'columns':
+        return logs_columns.write_logs(out_file, logs)
+    count = 0
+    if out_format == 'json':
+        out_file.write('{"logs": [')
+    for count, log in enumerate(logs, 1):
+        if out_format == 'json':
+            out_file.write('\n' if count == 1 else ',\n')
+        out_file.write(json.dumps(log, separators=(',', ':')))
+        if out_format == 'jsonl':
+            out_file.write('\n')
+    if out_format == 'json':
+        out_file.write('\n]}\n')
+    return count
+
+
+def open_output(out_filename, out_format, append=False):
+    if out_format == 'sqlite':
+        if not append and os.path.exists(out_filename):
+            os.remove(out_filename)
+        return closing(logs_db.connect(out_filename))
+    if out_format == 'columns':
+        return open(out_filename, 'wb')
+    if out_filename == '-':
+        return nullcontext(sys.stdout)
+    mode = 'a' if append else 'w'
+    if out_filename.endswith('.gz'):
+        # Appending to a gzip file adds a new gzip member, which is transparently read by gzip.open & zcat:
+        return gzip.open(out_filename, mode + 't', encoding='utf-8')
+    return open(out_filename, mode, encoding='utf-8')
 
 
 def parse_args(argv=None):
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                      description=__doc__, allow_abbrev=False)
-    parser.add_argument('--out-file', default='logs.json', help=' ')
-    return add_common_opts_and_parse_args(parser, argv)
+    parser.add_argument('--out-file', default='logs.json', help='Use - to write on stdout')
+    parser.add_argument('--format', choices=('json', 'jsonl', 'sqlite', 'columns'), default='json',
+                        help='jsonl produces one JSON log per line (JSON Lines), sqlite an indexed logs store, '
+                             'columns a compact columnar file of the fields analysed by logs_stats.py')
+    parser.add_argument('--page-size', type=int, default=0,
+                        help='Retrieve logs through several requests of this size, instead of a single one')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only append logs newer than the ones from the previous run to --out-file. Require --format jsonl or sqlite')
+    parser.add_argument('--state-file', help='Where --incremental stores the newest log timestamp dumped. Default to {out-file}.state.json')
+    args = add_common_opts_and_parse_args(parser, argv)
+    if args.incremental and args.format not in ('jsonl', 'sqlite'):
+        parser.error('--incremental require --format jsonl or sqlite')
+    if args.format in ('sqlite', 'columns') and (args.out_file == '-' or args.out_file.endswith('.gz')):
+        parser.error(f'--format {args.format} require a plain --out-file')
+    if not args.state_file:
+        if args.incremental and args.out_file == '-':
+            parser.error('--incremental with --out-file - require --state-file')
+        args.state_file = args.out_file + '.state.json'
+    return args
 
 
 if __name__ == '__main__':
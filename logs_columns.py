@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Convert a logs file extracted with dump_logs.py into a compact columnar file, for fast repeat analysis with logs_stats.py.
+
+Only the fields analysed by logs_stats.py are kept: timestamp, HTTP method & endpoint, VM name, status code,
+response message & errors messages. Strings are dictionary-encoded, so that each column is an array of integers,
+that logs_stats.py reads through memory-mapped, zero-copy views, without any JSON decoding.
+dump_logs.py can also directly produce such a file with --format columns.
+
+File layout, integers being little-endian:
+* MAGIC
+* length of the header, as an unsigned 64-bit integer
+* JSON header: logs count, strings table, errors messages table & offset of each column
+* columns, each one starting on an 8 bytes boundary
+'''
+
+# USAGE example:
+# $ ./logs_columns.py --logs-filename logs.json --out-file logs.cols
+# $ ./logs_stats.py --logs-filename logs.cols --since 2021-05-20
+
+import argparse, array, json, mmap, struct, sys
+from operator import itemgetter
+
+from logs_reader import LogsReader, open_logs
+
+
+MAGIC = b'ORKACOL1'
+# Orka timestamps have a fixed format, e.g. 2021-05-20T14:02:51.123Z, stored as a column of fixed-width ASCII strings:
+CREATED_AT_WIDTH = 24
+# Integer columns & their array typecodes. Except for status, they store indexes in the strings or errors tables:
+COLUMNS = (('method', 'I'), ('endpoint', 'I'), ('vm_name', 'I'), ('status', 'H'), ('message', 'I'), ('errors', 'I'))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open_logs(args.logs_filename) as logs_file, open(args.out_file, 'wb') as out_file:
+        count = write_logs(out_file, LogsReader(logs_file))
+    print(f'{count} logs written into {args.out_file}', file=sys.stderr)
+
+
+def is_logs_columns(filename):
+    try:
+        with open(filename, 'rb') as columns_file:
+            return columns_file.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def write_logs(out_file, logs):
+    '''
+    Write logs into a columnar file, and return how many were written.
+    Columns are kept in memory until all logs are read, which takes about 30 bytes per log.
+    '''
+    created_at, columns = bytearray(), {name: array.array(typecode) for name, typecode in COLUMNS}
+    strings, errors_table = {None: 0}, {(): 0}
+    for log in logs:
+        request, response = log.get('request') or {}, log.get('response') or {}
+        request_body, response_body = request.get('body'), response.get('body')
+        request_body = request_body if isinstance(request_body, dict) else {}
+        response_body = response_body if isinstance(response_body, dict) else {}
+        # The VM name is resolved from either the response or the request, as logs_stats.py does:
+        vm_name = (response_body.get('help') or {}).get('required_request_data_for_deploy', {}).get('orka_vm_name') or request_body.get('orka_vm_name')
+        errors = tuple(error.get('message') for error in response_body.get('errors') or ())
+        created_at += log['createdAt'].encode('ascii')[:CREATED_AT_WIDTH].ljust(CREATED_AT_WIDTH)
+        columns['method'].append(strings.setdefault(request.get('method'), len(strings)))
+        columns['endpoint'].append(strings.setdefault(request.get('url'), len(strings)))
+        columns['vm_name'].append(strings.setdefault(vm_name, len(strings)))
+        columns['status'].append(response.get('statusCode') or 0)
+        columns['message'].append(strings.setdefault(response_body.get('message'), len(strings)))
+        columns['errors'].append(errors_table.setdefault(errors, len(errors_table)))
+    offsets, offset = {'created_at': 0}, align(len(created_at))
+    for name, column in columns.items():
+        if sys.byteorder != 'little':
+            column.byteswap()
+        offsets[name], offset = offset, align(offset + len(column) * column.itemsize)
+    header = json.dumps({'count': len(created_at) // CREATED_AT_WIDTH, 'strings': list(strings), 'errors': list(errors_table), 'offsets': offsets},
+                        separators=(',', ':')).encode('utf-8')
+    data_start = align(len(MAGIC) + 8 + len(header))
+    out_file.write(MAGIC + struct.pack('<Q', len(header)) + header.ljust(data_start - len(MAGIC) - 8))
+    for column in (created_at, *columns.values()):
+        out_file.write(column)
+        out_file.write(bytes(offset_padding(len(column) * getattr(column, 'itemsize', 1))))
+    return len(created_at) // CREATED_AT_WIDTH
+
+
+def align(offset):
+    return offset + offset_padding(offset)
+
+
+def offset_padding(offset):
+    return -offset % 8
+
+
+class LogsColumns:
+    '''
+    Columnar logs file, memory-mapped, whose columns can be accessed by name as memoryviews of integers,
+    except created_at, accessed through created_at_values()
+    '''
+    def __init__(self, filename):
+        with open(filename, 'rb') as columns_file:
+            self.mmap = mmap.mmap(columns_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_len, = struct.unpack_from('<Q', self.mmap, len(MAGIC))
+        header = json.loads(self.mmap[len(MAGIC) + 8:len(MAGIC) + 8 + header_len])
+        self.count, self.strings = header['count'], header['strings']
+        self.errors = [tuple(errors) for errors in header['errors']]
+        data_start = align(len(MAGIC) + 8 + header_len)
+        self.views = [memoryview(self.mmap)]
+        self.columns = {}
+        for name, typecode in (('created_at', 'B'), *COLUMNS):
+            start = data_start + header['offsets'][name]
+            itemsize = CREATED_AT_WIDTH if name == 'created_at' else array.array(typecode).itemsize
+            view = self.views[0][start:start + self.count * itemsize]
+            self.views.append(view)
+            if name != 'created_at' and sys.byteorder != 'little':  # No zero-copy access then:
+                column = array.array(typecode, view.tobytes())
+                column.byteswap()
+                view = memoryview(column)
+            elif name != 'created_at':
+                view = view.cast(typecode)
+                self.views.append(view)
+            self.columns[name] = view
+        self.bodies = {}
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def close(self):
+        # Views on the memory map must be released before it can be closed:
+        for view in reversed(self.views):
+            view.release()
+        self.mmap.close()
+
+    def created_at_values(self):
+        'Iterate over created_at values as ASCII bytes, possibly right-padded with spaces'
+        return map(itemgetter(0), struct.iter_unpack(f'{CREATED_AT_WIDTH}s', self.columns['created_at']))
+
+    def value(self, name, code):
+        'Decode a value of the given column'
+        if name == 'status':
+            return code or None
+        return self.errors[code] if name == 'errors' else self.strings[code]
+
+    def response_body(self, message, errors):
+        'Return the response body of the given message & errors codes, a single dict being shared by all logs with the same ones'
+        body = self.bodies.get((message, errors))
+        if body is None:
+            body = self.bodies[message, errors] = {'message': self.strings[message], 'errors': [{'message': msg} for msg in self.errors[errors]]}
+        return body
+
+
+def iter_logs(columns, since='', vm_name=None):
+    'Yield logs created after since, optionally only for the given VM name, with only the fields stored in columns'
+    strings = columns.strings
+    for created_at, method, endpoint, vm_name_code, status, message, errors in zip(columns.created_at_values(), *(columns[name] for name, _ in COLUMNS)):
+        created_at = created_at.decode('ascii').rstrip()
+        if created_at < since or (vm_name and strings[vm_name_code] != vm_name):
+            continue
+        yield {'createdAt': created_at,
+               'request': {'method': strings[method], 'url': strings[endpoint], 'body': {'orka_vm_name': strings[vm_name_code]}},
+               'response': {'statusCode': status or None, 'body': columns.response_body(message, errors)}}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__, allow_abbrev=False)
+    parser.add_argument('--logs-filename', default='logs.json', help='Use - to read from stdin')
+    parser.add_argument('--out-file', default='logs.cols', help='Overwritten if it already exists')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Build a local SQLite store from a logs file extracted with dump_logs.py.
+
+Logs are indexed by timestamp, VM name, HTTP endpoint & response message,
+so that date-range & per-VM queries of logs_stats.py do not need to rescan all logs.
+dump_logs.py can also directly produce such a store with --format sqlite.
+'''
+
+# USAGE example:
+# $ ./logs_db.py --logs-filename logs.json --db-filename logs.db
+# $ ./logs_stats.py --logs-filename logs.db --since 2021-05-20
+# $ sqlite3 logs.db "SELECT vm_name, COUNT(*) FROM logs WHERE endpoint = '/resources/vm/deploy' GROUP BY vm_name"
+
+import argparse, json, sqlite3, sys
+from contextlib import closing
+
+from logs_reader import LogsReader, open_logs
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS logs (
+    created_at TEXT NOT NULL,
+    method TEXT,
+    endpoint TEXT,
+    vm_name TEXT,
+    status_code INTEGER,
+    message TEXT,
+    log TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS logs_by_created_at ON logs (created_at);
+CREATE INDEX IF NOT EXISTS logs_by_vm_name ON logs (vm_name, created_at);
+CREATE INDEX IF NOT EXISTS logs_by_endpoint ON logs (endpoint, created_at);
+CREATE INDEX IF NOT EXISTS logs_by_message ON logs (message, created_at);
+'''
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open_logs(args.logs_filename) as logs_file, closing(connect(args.db_filename)) as db:
+        count = insert_logs(db, LogsReader(logs_file))
+    print(f'{count} logs inserted into {args.db_filename}', file=sys.stderr)
+
+
+def is_logs_db(filename):
+    try:
+        with open(filename, 'rb') as db_file:
+            return db_file.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    except OSError:
+        return False
+
+
+def connect(db_filename):
+    db = sqlite3.connect(db_filename)
+    db.executescript(SCHEMA)
+    return db
+
+
+def insert_logs(db, logs):
+    'Insert logs as they come, in a single transaction, and return how many were inserted'
+    with db:
+        return db.executemany('INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?, ?)', map(log_to_row, logs)).rowcount
+
+
+def log_to_row(log):
+    request, response = log.get('request') or {}, log.get('response') or {}
+    request_body, response_body = request.get('body'), response.get('body')
+    return (
+        log['createdAt'],
+        request.get('method'),
+        request.get('url'),
+        request_body.get('orka_vm_name') if isinstance(request_body, dict) else None,
+        response.get('statusCode'),
+        response_body.get('message') if isinstance(response_body, dict) else None,
+        json.dumps(log, separators=(',', ':')),
+    )
+
+
+def count_logs(db):
+    return db.execute('SELECT COUNT(*) FROM logs').fetchone()[0]
+
+
+def query_logs(db, since='', vm_name=None):
+    'Yield logs created after since, optionally only for the given VM name, through the store indexes'
+    sql, params = 'SELECT log FROM logs WHERE created_at >= ?', [since]
+    if vm_name:
+        sql += ' AND vm_name = ?'
+        params.append(vm_name)
+    for (log,) in db.execute(sql + ' ORDER BY created_at', params):
+        yield json.loads(log)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__, allow_abbrev=False)
+    parser.add_argument('--logs-filename', default='logs.json', help='Use - to read from stdin')
+    parser.add_argument('--db-filename', default='logs.db', help='Logs are appended to it if it already exists')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Readers of the logs files written by dump_logs.py, as JSON or JSON Lines, optionally gzip-compressed,
+and of the {"logs": [...]} JSON documents returned by the Orka controller, decoded one log at a time.
+'''
+
+import gzip, io, itertools, json, sys
+from contextlib import contextmanager, nullcontext
+
+
+class JsonStreamReader:
+    'Minimal incremental JSON reader, decoding values one at a time from an iterable of text chunks'
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer, self.pos = '', 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        'Return the next non-whitespace character, or None at the end of the stream'
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return None
+
+    def expect(self, chars):
+        char = self.peek()
+        if char is None or char not in chars:
+            raise ValueError(f'Invalid JSON stream: expected one of {chars!r} but got {char!r}')
+        self.pos += 1
+        return char
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value ending exactly at the end of the buffer may be truncated, e.g. a number:
+                if end < len(self.buffer):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                pass
+            if not self._fill():
+                value, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+                return value
+
+
+def iter_json_array(chunks, key):
+    'Yield one by one the items of the array stored under `key` in the top-level JSON object read from `chunks`'
+    reader = JsonStreamReader(chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.decode()
+        reader.expect(':')
+        if name == key:
+            reader.expect('[')
+            if reader.peek() == ']':
+                return
+            while True:
+                yield reader.decode()
+                if reader.expect(',]') == ']':
+                    return
+        reader.decode()
+        if reader.expect(',}') == '}':
+            return
+
+
+@contextmanager
+def open_logs(logs_filename):
+    'Open a logs file as text, or stdin if logs_filename is -, transparently decompressing it if gzip-compressed'
+    with (nullcontext(sys.stdin.buffer) if logs_filename == '-' else open(logs_filename, 'rb')) as logs_file:
+        if logs_file.peek(2)[:2] == b'\x1f\x8b':
+            logs_file = gzip.GzipFile(fileobj=logs_file)
+        yield io.TextIOWrapper(logs_file, encoding='utf-8')
+
+
+class LogsReader:  # pylint: disable=too-few-public-methods
+    'Iterate once over the logs of a JSON Lines file or of a {"logs": [...]} JSON document, counting them'
+    def __init__(self, logs_file, chunk_size=64*1024):
+        self.logs_file = logs_file
+        self.chunk_size = chunk_size
+        self.count = 0
+
+    def __iter__(self):
+        for log in self._iter_logs():
+            self.count += 1
+            yield log
+
+    def _iter_logs(self):
+        first_line = self.logs_file.readline()
+        try:
+            first_log = json.loads(first_line)
+        except ValueError:
+            first_log = None
+        if isinstance(first_log, dict) and 'createdAt' in first_log:  # JSON Lines
+            yield first_log
+            for line in self.logs_file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            chunks = iter(lambda: self.logs_file.read(self.chunk_size), '')
+            yield from iter_json_array(itertools.chain([first_line], chunks), 'logs')
@@ -1,7 +1,17 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-'Script producing some statistics on logs frequency, based on a logs.json file extraced with dump_logs.py'
+'''
+Script producing some statistics on logs frequency, based on a logs.json file extraced with dump_logs.py
+
+Logs are read one by one, so that memory usage stays flat whatever the size of the logs file.
+Both the JSON & JSON Lines formats of dump_logs.py are supported, optionally gzip-compressed,
+as well as SQLite logs stores built by logs_db.py, where --since & --for-vm queries use indexes,
+and columnar files built by logs_columns.py, that are memory-mapped & counted without decoding each log.
+
+With --trends hour|day, logs are instead counted by time bucket, e.g. to graph the cluster saturation,
+along with the lifetimes of VMs from their deployment to their deletion, & written as a table, CSV or JSON.
+'''
 
 # USAGE example:
 # $ ./dump_logs.py && ./logs_stats.py --since 2021-05-20
@@ -14,60 +24,251 @@
 #     "Successfully deleted VM(s)":
 #     runner-xcode-12-5-0 107
 #     runner-xcode-12-4-0 15
+# $ ./logs_stats.py --target-message 'Successfully saved VM' --group-by orka_vm_name --group-by request.body.orka_base_image
+# $ ./dump_logs.py --format jsonl --out-file - | ./logs_stats.py --logs-filename -
+# $ ./logs_stats.py --trends hour -o csv > trends.csv
 
 import argparse, json, sys
 import re
-from collections import defaultdict
+from collections import Counter, deque
+from contextlib import closing
+from itertools import compress
 from datetime import datetime
 
+import logs_columns, logs_db
+from commons import add_output_opts, RowsWriter
+from logs_reader import LogsReader, open_logs
+
 
 TARGET_MESSAGES = (
     'Requested CPU is not available in the cluster',
     'Successfully deployed VM',
     'Successfully deleted VM(s)',
 )
+# Special group-by key, resolving the VM name from either the response or the request.
+# Any other group-by key is a dotted path into a log record, e.g. request.body.orka_base_image
+VM_NAME_KEY = 'orka_vm_name'
+DEPLOYED_MSG, DELETED_MSG = TARGET_MESSAGES[1:]
+# Shorter column names in --trends output:
+TREND_COLUMNS = {TARGET_MESSAGES[0]: 'cpu_not_available', DEPLOYED_MSG: 'deployed', DELETED_MSG: 'deleted'}
+# Length of the createdAt prefix identifying a time bucket, & suffix completing it into a readable date:
+BUCKETS = {'hour': (13, ':00'), 'day': (10, '')}
+# Group-by keys that can be counted directly from the columns of logs_columns.py files:
+GROUP_BY_COLUMNS = {VM_NAME_KEY: 'vm_name', 'request.method': 'method', 'request.url': 'endpoint',
+                    'response.statusCode': 'status', 'response.body.message': 'message'}
 
 
 def main(argv=None):
     args = parse_args(argv)
+    # Orka timestamps are ISO 8601 strings with a fixed format, that can be compared without parsing them:
+    since = args.since.isoformat() if args.since else ''
 
-    with open(args.logs_filename, encoding='utf-8') as logs_file:
-        logs = json.load(logs_file)['logs']
-    print('#logs:', len(logs))
+    if logs_db.is_logs_db(args.logs_filename):
+        with closing(logs_db.connect(args.logs_filename)) as db:
+            report(args, logs_db.query_logs(db, since, args.for_vm), since, lambda: logs_db.count_logs(db))
+    elif logs_columns.is_logs_columns(args.logs_filename):
+        group_by = args.group_by or [VM_NAME_KEY]
+        if not args.for_vm and not all(key in GROUP_BY_COLUMNS for key in group_by):
+            sys.exit(f'Only those --group-by keys are stored in columnar logs files: {", ".join(GROUP_BY_COLUMNS)}')
+        with closing(logs_columns.LogsColumns(args.logs_filename)) as columns:
+            report(args, logs_columns.iter_logs(columns, since, args.for_vm), since, lambda: columns.count, columns)
+    else:
+        with open_logs(args.logs_filename) as logs_file:
+            logs = LogsReader(logs_file)
+            report(args, logs, since, lambda: logs.count)
 
+
+def report(args, logs, since, count_logs, columns=None):
     if args.for_vm:
-        for log in logs:
-            log_date = datetime.strptime(log['createdAt'][:-5], '%Y-%m-%dT%H:%M:%S')
-            if args.since and log_date < args.since:
-                continue
-            if log['request']['body'].get('orka_vm_name') == args.for_vm:
-                print(json.dumps(log, indent=4))
+        vm_logs = [log for log in logs if log['createdAt'] >= since
+                   and log['request']['body'].get('orka_vm_name') == args.for_vm]
+        print('#logs:', count_logs())
+        for log in vm_logs:
+            print(json.dumps(log, indent=4))
+        return
+    target_messages = TARGET_MESSAGES + tuple(args.target_messages)
+    if args.trends:
+        trends = compute_trends(logs, target_messages, args.group_by or [VM_NAME_KEY], args.trends, since)
+        print('#logs:', count_logs(), file=sys.stderr)
+        write_trends(args, trends, target_messages)
         return
+    if columns:
+        stats = compute_stats_from_columns(columns, target_messages, args.group_by or [VM_NAME_KEY], since)
+    else:
+        stats = compute_stats(logs, target_messages, args.group_by or [VM_NAME_KEY], since)
+    print('#logs:', count_logs())
+    for target_msg, counter in stats.items():
+        print(f'"{target_msg}":')
+        for key, count in counter.most_common():
+            print(*key, count)
+
+
+def compute_stats(logs, target_messages, group_by, since=''):
+    '''
+    Count, in a single pass over the logs, the ones matching each target message, grouped by the group_by keys.
+    A log matches a target message if its response message is equal to it,
+    or if one of its response errors messages matches it as a regular expression.
+    Return a dict of Counters, indexed by target message & then by tuples of group_by values.
+    '''
+    stats = {target_msg: Counter() for target_msg in target_messages}
+    matching_messages = messages_matcher(target_messages)
+    key_paths = [None if key == VM_NAME_KEY else key.split('.') for key in group_by]
+    for log in logs:
+        if log['createdAt'] < since:
+            continue
+        matching_msgs = matching_messages(log)
+        if matching_msgs:
+            key = tuple(get_log_field(log, path) for path in key_paths)
+            for target_msg in matching_msgs:
+                stats[target_msg][key] += 1
+    return stats
+
+
+def compute_stats_from_columns(columns, target_messages, group_by, since=''):
+    '''
+    Same as compute_stats, for a logs_columns.LogsColumns file: logs are first counted by distinct codes of the needed columns,
+    which only iterates over the memory-mapped columns in C, and target messages are then matched once per distinct code.
+    '''
+    stats = {target_msg: Counter() for target_msg in target_messages}
+    matching_messages = messages_matcher(target_messages)
+    matches = {}
+    group_columns = [GROUP_BY_COLUMNS[key] for key in group_by]
+    rows = zip(columns['message'], columns['errors'], *(columns[name] for name in group_columns))
+    if since:
+        rows = compress(rows, map(since.encode('ascii').__le__, columns.created_at_values()))
+    for (message, errors, *codes), count in Counter(rows).items():
+        matching_msgs = matches.get((message, errors))
+        if matching_msgs is None:
+            matching_msgs = matches[message, errors] = matching_messages({'response': {'body': columns.response_body(message, errors)}})
+        if matching_msgs:
+            key = tuple(columns.value(name, code) for name, code in zip(group_columns, codes))
+            for target_msg in matching_msgs:
+                stats[target_msg][key] += count
+    return stats
+
+
+def compute_trends(logs, target_messages, group_by, bucket, since=''):
+    '''
+    Count, in a single pass over the logs, the ones matching each target message, by time bucket & group_by values.
+    VMs lifetimes are also measured, by pairing the deployments & deletions of each VM name in first-in first-out order,
+    and accounted for in the bucket & group of the deletion.
+    Return a dict indexed by (bucket, *group_by values) tuples, of lists of counters:
+    one count per target message, followed by the count, sum & max of lifetimes in seconds.
+    '''
+    matching_messages = messages_matcher(target_messages)
+    indexes = {target_msg: i for i, target_msg in enumerate(target_messages)}
+    key_paths = [None if key == VM_NAME_KEY else key.split('.') for key in group_by]
+    prefix_len, suffix = BUCKETS[bucket]
+    trends = {}
+    # By VM name, (date, is_deployment, counters) events not paired yet, all of the same kind:
+    unpaired = {}
+    for log in logs:
+        created_at = log['createdAt']
+        if created_at < since:
+            continue
+        matching_msgs = matching_messages(log)
+        if not matching_msgs:
+            continue
+        key = (created_at[:prefix_len] + suffix, *(get_log_field(log, path) for path in key_paths))
+        counters = trends.get(key)
+        if counters is None:
+            counters = trends[key] = [0] * (len(target_messages) + 3)
+        for target_msg in matching_msgs:
+            counters[indexes[target_msg]] += 1
+        is_deployment = DEPLOYED_MSG in matching_msgs
+        if is_deployment == (DELETED_MSG in matching_msgs):
+            continue
+        event, events = (created_at, is_deployment, counters), unpaired.setdefault(get_log_field(log, None), deque())
+        # Logs are sorted by date, either from the oldest to the newest, e.g. in SQLite stores, or the other way around, e.g. in dumps,
+        # so that an event can only be paired with the oldest unpaired one, & is otherwise kept to be paired with a later one:
+        while events and events[0][1] != is_deployment:
+            deployment, deletion = (event, events.popleft()) if is_deployment else (events.popleft(), event)
+            if deployment[0] <= deletion[0]:
+                lifetime = (parse_date(deletion[0]) - parse_date(deployment[0])).total_seconds()
+                deletion[2][-3] += 1
+                deletion[2][-2] += lifetime
+                deletion[2][-1] = max(deletion[2][-1], lifetime)
+                break
+            # Otherwise the unpaired event is a deletion before the first deployment, or a deployment after the last deletion
+        else:
+            events.append(event)
+    return trends
+
+
+def write_trends(args, trends, target_messages):
+    columns = ['bucket', *(args.group_by or [VM_NAME_KEY]), *(TREND_COLUMNS.get(target_msg, target_msg) for target_msg in target_messages)]
+    rows = ({**dict(zip(columns, (*key, *counters))), 'lifetimes': counters[-3],
+             'avg_lifetime_s': round(counters[-2] / counters[-3]) if counters[-3] else None, 'max_lifetime_s': round(counters[-1]) if counters[-3] else None}
+            for key, counters in sorted(trends.items(), key=lambda item: tuple(str(value) for value in item[0])))
+    if args.output != 'table':
+        with RowsWriter(args.output, args.fields) as writer:
+            for row in rows:
+                writer.write(row)
+        return
+    for i, row in enumerate(rows):
+        if not i:
+            print(' | '.join(row))
+        print(' | '.join('' if value is None else str(value) for value in row.values()))
+
+
+def messages_matcher(target_messages):
+    '''
+    Return a function returning the set of target messages a log matches:
+    its response message if equal to one of them, & those matching one of its response errors messages as a regular expression.
+    '''
+    targets = set(target_messages)
+    # Each target message is matched on its own, as an error message can match several of them,
+    # & the target messages matched by each distinct error message are cached, as most errors messages are repeated:
+    errors_regexes = [(target_msg, re.compile(target_msg)) for target_msg in target_messages]
+    errors_matches = {}
+    def matching_messages(log):
+        body = log['response']['body']
+        if not isinstance(body, dict):
+            return ()
+        matching_msgs = set()
+        if body.get('message') in targets:
+            matching_msgs.add(body['message'])
+        for error in body.get('errors', ()):
+            error_msg = error['message']
+            error_matches = errors_matches.get(error_msg)
+            if error_matches is None:
+                error_matches = errors_matches[error_msg] = [target_msg for target_msg, regex in errors_regexes if regex.match(error_msg)]
+            matching_msgs.update(error_matches)
+        return matching_msgs
+    return matching_messages
+
+
+def parse_date(created_at):
+    # Orka timestamps look like 2021-05-20T14:02:51.123Z, the sub-second part being irrelevant to VMs lifetimes:
+    return datetime.strptime(created_at[:19], '%Y-%m-%dT%H:%M:%S')
+
 
-    for vm_deploy_msg in TARGET_MESSAGES:
-        vms = defaultdict(int)
-        for log in logs:
-            log_date = datetime.strptime(log['createdAt'][:-5], '%Y-%m-%dT%H:%M:%S')
-            if args.since and log_date < args.since:
-                continue
-            body = log['response']['body']
-            if isinstance(body, dict):
-                ok_msg_match = body.get('message') == vm_deploy_msg
-                error_msg_match = any(re.match(vm_deploy_msg, error['message']) for error in body.get('errors', []))
-                if ok_msg_match or error_msg_match:
-                    orka_vm_name = body.get('help', {}).get('required_request_data_for_deploy', {}).get('orka_vm_name') or log['request']['body']['orka_vm_name']
-                    vms[orka_vm_name] += 1
-        print(f'"{vm_deploy_msg}":')
-        for vm_name, count in sorted(vms.items(), key=lambda vm: vm[1], reverse=True):
-            print(vm_name, count)
+def get_log_field(log, path):
+    if path is None:
+        body = log['response']['body']
+        return body.get('help', {}).get('required_request_data_for_deploy', {}).get('orka_vm_name') or log['request']['body'].get('orka_vm_name')
+    value = log
+    for name in path:
+        value = value.get(name) if isinstance(value, dict) else None
+    return value
 
 
 def parse_args(argv=None):
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                      description=__doc__, allow_abbrev=False)
     parser.add_argument('--for-vm', help='Display all logs matching this VM name & exit')
-    parser.add_argument('--logs-filename', default='logs.json', help=' ')
+    parser.add_argument('--logs-filename', default='logs.json',
+                        help='Use - to read from stdin. Can also be a SQLite logs store, or a columnar logs file')
     parser.add_argument('--since', help='Date must be specified with this format: YYYY-MM-DD')
+    parser.add_argument('--target-message', dest='target_messages', action='append', default=[],
+                        help=f'Additional message to count logs for, on top of: {", ".join(TARGET_MESSAGES)}. '
+                              'It is also matched as a regular expression against response errors messages')
+    parser.add_argument('--group-by', action='append',
+                        help=f'Log field to group counts by, as a dotted path like request.body.orka_base_image. '
+                             f'Can be repeated. Default to {VM_NAME_KEY}, resolved from the request or the response')
+    parser.add_argument('--trends', choices=BUCKETS,
+                        help='Count logs by time bucket of this size, along with VMs lifetimes from their deployment to their deletion')
+    add_output_opts(parser)
     args = parser.parse_args(argv)
     if args.since:
         args.since = datetime.strptime(args.since, '%Y-%m-%d')
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Fake Orka controller, implementing the API endpoints called by the scripts of this repository,
+so that they can be run & benchmarked without a live cluster.
+
+The dataset size, the latency of responses & the rate of failed requests are configurable.
+VMs, nodes, images & users are kept in memory and updated by write requests.
+Logs are generated on the fly when requested, so that millions of them are served with a flat memory usage.
+
+The number of requests received, by endpoint, is exposed on GET /_stats
+'''
+
+# USAGE: ./mock_orka_controller.py --vms 5000 --logs 1000000 --latency .05 --error-rate .01
+#        ORKA_CONTROLLER_URL=http://127.0.0.1:8001 ORKA_LICENSE_KEY=key ORKA_USER_EMAIL=user@example.com ORKA_PASSWORD=pwd ./audit_vms.py
+# Orka API reference: https://documenter.getpostman.com/view/6574930/S1ETRGzt
+
+import argparse, json, random, re, secrets, sys, threading, time
+from collections import Counter
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+BASE_IMAGES = ('90GBigSurSSH.img', 'catalina-xcode-12-4.img', 'bigsur-xcode-12-5.img', 'monterey-xcode-13-1.img')
+TAGS = ('builder', 'xcode', 'tests', None)
+NODE_CPU, NODE_MEMORY_GB = 24, 64
+LOGS_INTERVAL = timedelta(seconds=10)
+LOGS_CHUNK_SIZE = 1000
+ROUTE_GROUP_REGEX = re.compile(r'\(\?P<(\w+)>[^)]*\)')
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = MockOrkaController((args.address, args.port), MockOrkaHandler, Cluster(args), args)
+    # Printed first, so that callers using --port 0 can retrieve the port picked:
+    print(f'Listening on http://{server.server_address[0]}:{server.server_address[1]}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+class Cluster:  # pylint: disable=too-many-instance-attributes
+    'In-memory state of the fake cluster'
+    def __init__(self, args):
+        rand = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.now = datetime.utcnow().replace(microsecond=0)
+        self.nb_logs = args.logs
+        self.user_email = args.user_email
+        self.users = {'admin@example.com', args.user_email} | {f'user{i}@example.com' for i in range(args.users)}
+        self.tokens = set()
+        self.nodes = {}
+        for i in range(1, args.nodes + 1):
+            self.nodes[f'macpro-{i}'] = {'name': f'macpro-{i}', 'address': f'10.0.{i // 256}.{i % 256}', 'hostIP': f'10.0.{i // 256}.{i % 256}',
+                                         'allocatable_cpu': NODE_CPU, 'available_cpu': NODE_CPU, 'allocatable_gpu': 0, 'available_gpu': 0,
+                                         'total_memory': f'{NODE_MEMORY_GB}G', 'available_memory': f'{NODE_MEMORY_GB}G', 'state': 'READY',
+                                         'orka_tags': [TAGS[i % len(TAGS)]] if TAGS[i % len(TAGS)] else []}
+        self.images = {image: self.image(image) for image in BASE_IMAGES + tuple(f'image-{i}.img' for i in range(args.images))}
+        self.vms, self.next_vm_id = {}, 0
+        for i in range(args.vms):
+            base_image = rand.choice(BASE_IMAGES)
+            self.vms[f'runner-{i}'] = {'virtual_machine_name': f'runner-{i}', 'owner': rand.choice(sorted(self.users)), 'cpu': rand.choice((3, 6, 12)),
+                                      'base_image': base_image, 'image': base_image, 'tag': rand.choice(TAGS), 'tag_required': False, 'status': []}
+            self.vms[f'runner-{i}']['vcpu'] = self.vms[f'runner-{i}']['cpu']
+            # Most VMs are deployed, for up to 3 days:
+            if rand.random() < args.deployed_ratio:
+                self.deploy(f'runner-{i}', self.now - timedelta(hours=rand.uniform(0, 72)))
+
+    @staticmethod
+    def image(name, owner='admin@example.com'):
+        return {'image': name, 'image_size': '90G', 'modified': '2021-06-01T10:00:00.000Z', 'date_added': '2021-06-01T10:00:00.000Z', 'owner': owner}
+
+    def vm_resource(self, vm):
+        if not vm['status']:
+            return {'virtual_machine_name': vm['virtual_machine_name'], 'vm_deployment_status': 'Not Deployed', 'owner': vm['owner'],
+                    'cpu': vm['cpu'], 'vcpu': vm['vcpu'], 'base_image': vm['base_image'], 'image': vm['image'], 'io_boost': False, 'use_saved_state': False}
+        return {'virtual_machine_name': vm['virtual_machine_name'], 'vm_deployment_status': 'Deployed', 'status': vm['status']}
+
+    def deploy(self, vm_name, creation_date=None):
+        vm = self.vms[vm_name]
+        # VMs are placed on the node with the most CPU available:
+        node = max(self.nodes.values(), key=lambda node: node['available_cpu'])
+        if node['available_cpu'] < vm['cpu']:
+            return None
+        node['available_cpu'] -= vm['cpu']
+        node['available_memory'] = f"{int(node['available_memory'][:-1]) - vm['cpu'] * 2}G"
+        self.next_vm_id += 1
+        vm_id = f'{self.next_vm_id:012x}'
+        vm['status'].append({'owner': vm['owner'], 'virtual_machine_name': vm_name, 'virtual_machine_id': vm_id, 'node_location': node['name'],
+                             'node_status': 'UP', 'virtual_machine_ip': node['address'], 'vnc_port': '6000', 'screen_sharing_port': '5900',
+                             'ssh_port': str(8822 + self.next_vm_id % 1000), 'cpu': vm['cpu'], 'vcpu': vm['vcpu'], 'RAM': f"{vm['cpu'] * 2}G",
+                             'base_image': vm['base_image'], 'image': vm['image'], 'configuration_template': 'default', 'vm_status': 'running',
+                             'io_boost': False, 'use_saved_state': False, 'reserved_ports': [],
+                             'creation_timestamp': f'{creation_date or datetime.utcnow():%Y-%m-%dT%H:%M:%SZ}',
+                             'tag': vm['tag'], 'tag_required': vm['tag_required']})
+        return vm['status'][-1]
+
+    def delete(self, name_or_id):
+        'Delete all the instances of a VM, or a single instance given its ID, and return how many were deleted'
+        deleted = 0
+        for vm in self.vms.values():
+            for status in list(vm['status']):
+                if name_or_id in (vm['virtual_machine_name'], status['virtual_machine_id']):
+                    node = self.nodes[status['node_location']]
+                    node['available_cpu'] += status['cpu']
+                    node['available_memory'] = f"{int(node['available_memory'][:-1]) + status['cpu'] * 2}G"
+                    vm['status'].remove(status)
+                    deleted += 1
+        return deleted
+
+    def log(self, i):
+        'Generate the i-th log, from the newest to the oldest one'
+        vm_name = f'runner-{i * 7919 % max(len(self.vms), 1)}'
+        created_at = f'{self.now - i * LOGS_INTERVAL:%Y-%m-%dT%H:%M:%S}.000Z'
+        kind = i % 10
+        if kind < 5:
+            request = {'method': 'POST', 'url': '/resources/vm/deploy', 'body': {'orka_vm_name': vm_name}}
+            response = {'statusCode': 200, 'body': {'message': 'Successfully deployed VM', 'help': {}, 'errors': []}}
+        elif kind < 8:
+            request = {'method': 'DELETE', 'url': '/resources/vm/delete', 'body': {'orka_vm_name': vm_name}}
+            response = {'statusCode': 200, 'body': {'message': 'Successfully deleted VM(s)', 'help': {}, 'errors': []}}
+        elif kind == 8:
+            request = {'method': 'POST', 'url': '/resources/vm/deploy', 'body': {'orka_vm_name': vm_name}}
+            response = {'statusCode': 500, 'body': {'message': '', 'errors': [{'message': 'Requested CPU is not available in the cluster'}],
+                                                    'help': {'required_request_data_for_deploy': {'orka_vm_name': vm_name}}}}
+        else:
+            request = {'method': 'POST', 'url': '/resources/vm/create',
+                       'body': {'orka_vm_name': vm_name, 'orka_base_image': BASE_IMAGES[i % len(BASE_IMAGES)], 'orka_cpu_core': 6, 'vcpu_count': 6}}
+            response = {'statusCode': 201, 'body': {'message': 'Successfully created VM config', 'help': {}, 'errors': []}}
+        request['headers'] = {'host': 'orka-controller', 'user-agent': 'orka-tools'}
+        return {'_id': f'{i:024x}', 'createdAt': created_at, 'level': 'info', 'request': request, 'response': response}
+
+
+class MockOrkaController(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, cluster, args):
+        super().__init__(server_address, handler_class)
+        self.cluster = cluster
+        self.latency = args.latency
+        self.error_rate = args.error_rate
+        self.stats = Counter()
+        self.errors_injected = 0
+        self.stats_lock = threading.Lock()
+
+    def count(self, endpoint, error_injected=False):
+        with self.stats_lock:
+            self.stats[endpoint] += 1
+            self.errors_injected += error_injected
+
+
+class MockOrkaHandler(BaseHTTPRequestHandler):  # pylint: disable=too-many-public-methods
+    protocol_version = 'HTTP/1.1'  # Keep-alive connections, as the real controller
+    # Headers & body are sent in separate writes, that Nagle's algorithm would delay on kept-alive connections:
+    disable_nagle_algorithm = True
+    # (method, path regex, handler method name), the names of the regex groups being passed as arguments:
+    ROUTES = (
+        ('POST', r'/token', 'login'),
+        ('GET', r'/resources/vm/list/all', 'vm_list'),
+        ('GET', r'/resources/vm/status/(?P<name>[^/]+)', 'vm_status'),
+        ('POST', r'/resources/vm/create', 'vm_create'),
+        ('POST', r'/resources/vm/deploy', 'vm_deploy'),
+        ('DELETE', r'/resources/vm/delete', 'vm_delete'),
+        ('DELETE', r'/resources/vm/purge', 'vm_purge'),
+        ('POST', r'/resources/vm/exec/suspend', 'vm_exec'),
+        ('GET', r'/resources/image/list', 'image_list'),
+        ('POST', r'/resources/image/(?P<action>save|commit|rename|delete)', 'image_update'),
+        ('GET', r'/resources/node/list', 'node_list'),
+        ('GET', r'/resources/node/status/(?P<name>[^/]+)', 'node_status'),
+        ('GET', r'/users', 'user_list'),
+        ('POST', r'/users/?', 'user_create'),
+        ('DELETE', r'/users/(?P<email>[^/]+)', 'user_delete'),
+        ('POST', r'/logs/query', 'logs_query'),
+    )
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path == '/_stats':
+            with self.server.stats_lock:
+                stats = {'requests': sum(self.server.stats.values()), 'errors_injected': self.server.errors_injected, 'by_endpoint': dict(self.server.stats)}
+            self.reply(200, stats)
+            return
+        self.route()
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self.route()
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        self.route()
+
+    def route(self):
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        for method, path_regex, handler_name in self.ROUTES:
+            match = re.fullmatch(path_regex, url.path)
+            if method == self.command and match:
+                break
+        else:
+            self.server.count(f'{self.command} {url.path}')
+            self.reply(404, {'message': 'Not found', 'errors': [{'message': f'No route for {self.command} {url.path}'}]})
+            return
+        error_injected = bool(self.server.error_rate) and random.random() < self.server.error_rate
+        # Endpoints are counted by route, e.g. GET /resources/vm/status/{name}:
+        self.server.count(method + ' ' + ROUTE_GROUP_REGEX.sub(r'{\1}', path_regex), error_injected)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if error_injected:
+            self.reply(500, {'message': 'Internal Server Error', 'errors': [{'message': 'Injected error'}]})
+            return
+        if handler_name != 'login' and self.headers.get('Authorization', '')[len('Bearer '):] not in self.server.cluster.tokens:
+            self.reply(401, {'message': 'Unauthorized', 'errors': [{'message': 'Invalid or expired token'}]})
+            return
+        try:
+            payload = json.loads(body) if self.headers.get('Content-Type', '').startswith('application/json') else parse_qs(body.decode('utf-8'))
+        except ValueError:
+            self.reply(400, {'message': 'Invalid JSON body'})
+            return
+        with self.server.cluster.lock if handler_name != 'logs_query' else nullcontext():
+            getattr(self, handler_name)(payload, query=parse_qs(url.query), **{key: unquote(value) for key, value in match.groupdict().items()})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *_):  # pylint: disable=arguments-differ
+        pass
+
+    # pylint: disable=unused-argument
+    def login(self, payload, query):
+        token = secrets.token_hex(16)
+        self.server.cluster.tokens.add(token)
+        self.reply(200, {'message': 'Login successful', 'token': token})
+
+    def vm_list(self, payload, query):
+        cluster = self.server.cluster
+        self.reply(200, {'message': '', 'help': {}, 'errors': [],
+                         'virtual_machine_resources': [cluster.vm_resource(vm) for vm in cluster.vms.values()]})
+
+    def vm_status(self, payload, query, name):
+        cluster = self.server.cluster
+        vms = [cluster.vm_resource(cluster.vms[name])] if name in cluster.vms else []
+        self.reply(200, {'message': '', 'help': {}, 'errors': [], 'virtual_machine_resources': vms})
+
+    def vm_create(self, payload, query):
+        vm_name = payload.get('orka_vm_name')
+        if not vm_name or vm_name in self.server.cluster.vms:
+            self.reply(400, {'message': '', 'errors': [{'message': f'Invalid or existing VM name: {vm_name}'}]})
+            return
+        self.server.cluster.vms[vm_name] = {'virtual_machine_name': vm_name, 'owner': self.server.cluster.user_email,
+                                            'cpu': payload.get('orka_cpu_core', 3), 'vcpu': payload.get('vcpu_count', 3),
+                                            'base_image': payload.get('orka_base_image'), 'image': payload.get('orka_image'),
+                                            'tag': payload.get('tag'), 'tag_required': payload.get('tag_required', False), 'status': []}
+        self.reply(201, {'message': 'Successfully created VM config', 'help': {}, 'errors': []})
+
+    def vm_deploy(self, payload, query):
+        vm_name = payload.get('orka_vm_name')
+        if vm_name not in self.server.cluster.vms:
+            self.reply(404, {'message': '', 'errors': [{'message': f'No VM config named {vm_name}'}]})
+            return
+        status = self.server.cluster.deploy(vm_name)
+        if not status:
+            self.reply(500, {'message': '', 'errors': [{'message': 'Requested CPU is not available in the cluster'}],
+                             'help': {'required_request_data_for_deploy': {'orka_vm_name': vm_name}}})
+            return
+        self.reply(200, {'message': 'Successfully deployed VM', 'help': {}, 'errors': [], 'vm_id': status['virtual_machine_id'],
+                         'ip': status['virtual_machine_ip'], 'ssh_port': status['ssh_port'], 'vnc_port': status['vnc_port']})
+
+    def vm_delete(self, payload, query):
+        if not self.server.cluster.delete(payload.get('orka_vm_name')):
+            self.reply(404, {'message': '', 'errors': [{'message': f"No VM named {payload.get('orka_vm_name')}"}]})
+            return
+        self.reply(200, {'message': 'Successfully deleted VM(s)', 'help': {}, 'errors': []})
+
+    def vm_purge(self, payload, query):
+        vm_name = payload.get('orka_vm_name')
+        if vm_name not in self.server.cluster.vms:
+            self.reply(404, {'message': '', 'errors': [{'message': f'No VM named {vm_name}'}]})
+            return
+        self.server.cluster.delete(vm_name)
+        del self.server.cluster.vms[vm_name]
+        self.reply(200, {'message': 'Successfully purged VM', 'help': {}, 'errors': []})
+
+    def vm_exec(self, payload, query):
+        self.reply(200, {'message': 'Successfully suspended VM', 'help': {}, 'errors': []})
+
+    def image_list(self, payload, query):
+        self.reply(200, {'message': '', 'help': {}, 'errors': [], 'image_attributes': list(self.server.cluster.images.values())})
+
+    def image_update(self, payload, query, action):
+        images = self.server.cluster.images
+        if action in ('save', 'commit'):
+            name = payload.get('new_name') or payload.get('orka_vm_name') + '.img'
+            images[name] = Cluster.image(name)
+        elif payload.get('image') not in images:
+            self.reply(404, {'message': '', 'errors': [{'message': f"No image named {payload.get('image')}"}]})
+            return
+        elif action == 'rename':
+            images[payload['new_name']] = dict(images.pop(payload['image']), image=payload['new_name'])
+        else:
+            del images[payload['image']]
+        past_action = {'save': 'saved', 'commit': 'committed', 'rename': 'renamed', 'delete': 'deleted'}[action]
+        self.reply(200, {'message': f'Successfully {past_action} image', 'help': {}, 'errors': []})
+
+    def node_list(self, payload, query):
+        self.reply(200, {'message': '', 'help': {}, 'errors': [], 'nodes': list(self.server.cluster.nodes.values())})
+
+    def node_status(self, payload, query, name):
+        node = self.server.cluster.nodes.get(name)
+        if not node:
+            self.reply(404, {'message': '', 'errors': [{'message': f'No node named {name}'}]})
+            return
+        self.reply(200, {'message': '', 'help': {}, 'errors': [], 'node_status': node})
+
+    def user_list(self, payload, query):
+        self.reply(200, {'message': '', 'help': {}, 'errors': [], 'user_groups': {'$ungrouped': sorted(self.server.cluster.users)}})
+
+    def user_create(self, payload, query):
+        self.server.cluster.users.add(payload.get('email'))
+        self.reply(201, {'message': 'User created', 'help': {}, 'errors': []})
+
+    def user_delete(self, payload, query, email):
+        self.server.cluster.users.discard(email)
+        self.reply(200, {'message': 'User deleted', 'help': {}, 'errors': []})
+
+    def logs_query(self, payload, query):
+        'Stream the requested page of logs with a chunked response, generating them on the fly'
+        nb_logs = self.server.cluster.nb_logs
+        start = int(query.get('start', ['0'])[0])
+        limit = int(query.get('limit', ['0'])[0]) or nb_logs
+        end = min(start + limit, nb_logs)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.write_chunk('{"message": "", "help": {}, "errors": [], "logs": [')
+        for chunk_start in range(start, end, LOGS_CHUNK_SIZE):
+            logs = (self.server.cluster.log(i) for i in range(chunk_start, min(chunk_start + LOGS_CHUNK_SIZE, end)))
+            self.write_chunk((',' if chunk_start > start else '') + ','.join(json.dumps(log) for log in logs))
+        self.write_chunk(']}')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__, allow_abbrev=False)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001, help='Use 0 to pick a free port, printed on stdout at startup')
+    parser.add_argument('--vms', type=int, default=100, help='Number of VM configs')
+    parser.add_argument('--deployed-ratio', type=float, default=.8, help='Fraction of the VM configs that are deployed at startup')
+    parser.add_argument('--nodes', type=int, default=20)
+    parser.add_argument('--images', type=int, default=20, help='Number of images, on top of a few base images')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--user-email', default='user@example.com', help='User email, on top of generated ones')
+    parser.add_argument('--logs', type=int, default=10000, help='Number of log records')
+    parser.add_argument('--latency', type=float, default=0, help='Delay in seconds before answering each request')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of the requests answered with a 500 error')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the random generation of the dataset')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
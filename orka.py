@@ -21,10 +21,12 @@ as we only required a subset of them in our Ansible playbook.
 # USAGE: ./orka.py --help
 # Orka API reference: https://documenter.getpostman.com/view/6574930/S1ETRGzt
 
-import argparse, json, sys
+import argparse, contextvars, io, json, math, re, shlex, socket, sys, time
+from contextlib import contextmanager, nullcontext
+from fnmatch import fnmatch
 from getpass import getpass
 
-from commons import add_common_opts_and_parse_args, check_http_status, orka_session, ArgparseHelpFormatter
+from commons import add_common_opts_and_parse_args, add_output_opts, check_http_status, orka_session, run_concurrently, snapshot_module, ArgparseHelpFormatter, RowsWriter
 
 
 def main(argv):
@@ -33,9 +35,21 @@ def main(argv):
         args.func(args, session)
 
 
-def vm_list(_, session):
+def vm_list(args, session):
     resp = check_http_status(session.get('/resources/vm/list/all'))
-    deployed_vms = [vm for vm in resp.json()["virtual_machine_resources"] if "status" in vm]
+    if args.snapshot and write_vms_changes(args, resp):
+        return
+    vms = resp.json()["virtual_machine_resources"]
+    deployed_vms = [vm for vm in vms if "status" in vm]
+    not_deployed_vms = [vm for vm in vms if "status" not in vm]
+    if args.output != 'table':
+        with RowsWriter(args.output, args.fields) as writer:
+            for vm in deployed_vms:
+                for status in vm["status"]:
+                    writer.write({"virtual_machine_name": vm["virtual_machine_name"], "vm_deployment_status": vm.get("vm_deployment_status"), **status})
+            for vm in not_deployed_vms:
+                writer.write(vm)
+        return
     print(f"Deployed: {len(deployed_vms)}")
     if deployed_vms:
         print('        Name        │      ID       │       Owner       │     Node      │      IP       │ VNC  │ SSH  │ vCPU/CPU │ RAM │          Base image           │ Status  │ Deploy Date')
@@ -43,13 +57,26 @@ def vm_list(_, session):
         status = vm["status"][0]
         print(f"{vm['virtual_machine_name']:<19} | {status['virtual_machine_id']:<13} | {status['owner']:<17} | {status['node_location']:<8} ({status['node_status']:<2}) | {status['virtual_machine_ip']:<13} | {status['vnc_port']} | {status['ssh_port']} | {status['cpu']}/{status['vcpu']}      | {status['RAM']:<3} | {status['base_image']:<29} | {status['vm_status']:<7} | {status['creation_timestamp']}")
     print()
-    not_deployed_vms = [vm for vm in resp.json()["virtual_machine_resources"] if "status" not in vm]
     print(f"Not Deployed: {len(not_deployed_vms)}")
     if not_deployed_vms:
         print('        Name        │       Owner       │ vCPU/CPU │ Base image')
     for vm in not_deployed_vms:
         print(f"{vm['virtual_machine_name']:<19} | {vm['owner']:<17} | {vm['cpu']}/{vm['vcpu']}      | {vm['base_image']}")
 
+def write_vms_changes(args, resp):
+    'Write the VMs changes since the --snapshot, and return True if they are the only output requested'
+    snapshots = snapshot_module()
+    changes = snapshots.snapshot_changes(resp, args.snapshot)
+    if args.changes_only:
+        snapshots.write_changes(changes, args.output, args.fields)
+        return True
+    if changes:  # Reported before the listing, as they are not reported again by the next call:
+        out = sys.stdout if args.output == 'table' else sys.stderr
+        print(f"Changes since the previous call: {len(changes)}", file=out)
+        snapshots.write_changes(changes, out=out)
+        print(file=out)
+    return False
+
 def vm_status(args, session):
     resp = check_http_status(session.get(f'/resources/vm/status/{args.vm}'))
     vms = resp.json()["virtual_machine_resources"]
@@ -98,14 +125,123 @@ def vm_create_config(args, session):
     print(json.dumps(resp.json(), indent=4))
 
 def vm_deploy(args, session):
-    resp = check_http_status(session.post('/resources/vm/deploy',
-                                          json={"orka_vm_name": args.vm}))
-    print(json.dumps(resp.json(), indent=4))
+    vms = resolve_vms(args, session)
+    start = time.monotonic()
+    if args.check_capacity or args.wait_for_capacity:
+        resp = check_http_status(session.get('/resources/vm/list/all'))
+        vm_configs = {vm['virtual_machine_name']: vm for vm in resp.json()["virtual_machine_resources"]}
+        unknown_vms = [vm for vm in vms if vm not in vm_configs]
+        if unknown_vms:
+            print("No VM config found with this name:", ' '.join(unknown_vms))
+            sys.exit(1)
+        def deploy(vm):
+            ensure_capacity(args, session, vm, vm_requirements(vm_configs[vm]))
+            return session.post('/resources/vm/deploy', json={"orka_vm_name": vm})
+        deployed = run_on_targets(args, vms, deploy)
+    else:
+        deployed = run_on_targets(args, vms, lambda vm: session.post('/resources/vm/deploy', json={"orka_vm_name": vm}))
+    if args.wait:
+        wait_for_vms(args, session, {vm: body.get("vm_id") for vm, body in deployed.items()}, {'deploy': time.monotonic() - start})
 
 def vm_create(args, session):
     args.tag_required = False
+    start, timings = time.monotonic(), {}
+    # Checked before creating the VM config, so that it is not left behind if there is no capacity:
+    if args.check_capacity or args.wait_for_capacity:
+        ensure_capacity(args, session, args.vm, (args.cpu, None, False))
+        timings['capacity'] = time.monotonic() - start
     vm_create_config(args, session)
-    vm_deploy(args, session)
+    timings['config'] = time.monotonic() - start - sum(timings.values())
+    resp = check_http_status(session.post('/resources/vm/deploy',
+                                          json={"orka_vm_name": args.vm}))
+    print(json.dumps(resp.json(), indent=4))
+    if args.wait:
+        timings['deploy'] = time.monotonic() - start - sum(timings.values())
+        wait_for_vms(args, session, {args.vm: resp.json().get("vm_id")}, timings)
+
+def vm_requirements(vm):
+    'Return the (cpu, tag, tag_required) requested by a VM, as listed by /resources/vm/list/all'
+    config = vm if 'cpu' in vm else vm["status"][0]
+    return int(config['cpu']), config.get('tag'), bool(config.get('tag_required'))
+
+def ensure_capacity(args, session, vm, requirements):
+    '''
+    Check that a node can currently fit a VM, to avoid a failed deploy round-trip,
+    or with --wait-for-capacity poll the nodes until one can.
+    requirements is a (cpu, tag, tag_required) tuple, as returned by vm_requirements.
+    '''
+    cpu, tag, tag_required = requirements
+    required_tag = tag if tag_required else None
+    def fitting_nodes():
+        return [node for node in list_nodes(session, no_cache=True) if node_free_slots(node, cpu, args.memory and args.memory * cpu, required_tag)]
+    if args.wait_for_capacity:
+        poll(fitting_nodes, time.monotonic() + args.capacity_timeout, f"No capacity for VM {vm} after {args.capacity_timeout}s", max_delay=30)
+    elif not fitting_nodes():
+        raise RuntimeError(f"No node can currently fit VM {vm} ({cpu} CPU" + (f", {args.memory * cpu:g}GB" if args.memory else "")
+                           + (f", tag {required_tag}" if required_tag else "") + ")")
+
+def wait_for_vms(args, session, vm_ids, timings):
+    '''
+    Wait for VMs instances, given as {VM name: ID of the instance deployed}, to be ready,
+    and print on stderr the time spent in each step, so that stdout can still be parsed
+    '''
+    failures = 0
+    for vm, vm_timings, error, _ in run_concurrently(lambda vm: wait_for_vm(session, vm, vm_ids[vm], args.wait_timeout), vm_ids, args.concurrency):
+        if error:
+            failures += 1
+            print(f"VM {vm} not ready: {error}", file=sys.stderr)
+            continue
+        vm_timings = {**timings, **vm_timings}
+        print(f"VM {vm} ready in {sum(vm_timings.values()):.1f}s: " + ' '.join(f'{step}={duration:.1f}s' for step, duration in vm_timings.items()), file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+def wait_for_vm(session, vm, vm_id, timeout):
+    '''
+    Poll the status of a VM instance with an exponential backoff until it is scheduled on a node, then until it is running,
+    and finally until its SSH port answers. Return the duration of each of those steps.
+    Other instances of the same VM are ignored. If vm_id is unknown, the last instance deployed is waited for.
+    '''
+    deadline = time.monotonic() + timeout
+    def get_status():
+        resp = check_http_status(session.get(f'/resources/vm/status/{vm}', headers={'Cache-Control': 'no-cache'}))
+        vms = resp.json()["virtual_machine_resources"]
+        statuses = vms[0].get("status") or [] if vms else []
+        if vm_id is None:
+            return statuses[-1] if statuses else None
+        return next((status for status in statuses if status["virtual_machine_id"] == vm_id), None)
+    def get_running_status():
+        status = get_status()
+        return status if status and status["vm_status"].lower() == "running" else None
+    timings, step_start = {}, time.monotonic()
+    def end_step(step):
+        nonlocal step_start
+        timings[step], step_start = time.monotonic() - step_start, time.monotonic()
+    poll(get_status, deadline, f"VM {vm} not scheduled")
+    end_step('scheduling')
+    status = poll(get_running_status, deadline, f"VM {vm} not running")
+    end_step('boot')
+    poll(lambda: ssh_banner_received(status["virtual_machine_ip"], int(status["ssh_port"])), deadline, f"SSH not ready on VM {vm}")
+    end_step('ssh_ready')
+    return timings
+
+def poll(check, deadline, timeout_msg, delay=.5, max_delay=10):
+    'Call check with an exponential backoff until it returns a truthy value, which is returned, or until the deadline'
+    while True:
+        result = check()
+        if result:
+            return result
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(timeout_msg)
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+def ssh_banner_received(host, port, timeout=3):
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            return sock.recv(4) == b'SSH-'
+    except OSError:
+        return False
 
 def vm_suspend(args, session):
     resp = check_http_status(session.post('/resources/vm/exec/suspend',
@@ -113,19 +249,67 @@ def vm_suspend(args, session):
     print(json.dumps(resp.json(), indent=4))
 
 def vm_delete(args, session):
-    resp = check_http_status(session.delete('/resources/vm/delete',
-                                            json={"orka_vm_name": args.vm}))
-    print(json.dumps(resp.json(), indent=4))
+    run_on_targets(args, resolve_vms(args, session, deployed_only=True),
+                   lambda vm: session.delete('/resources/vm/delete', json={"orka_vm_name": vm}))
 
 def vm_purge(args, session):
-    resp = check_http_status(session.delete('/resources/vm/purge',
-                                            json={"orka_vm_name": args.vm}))
-    print(json.dumps(resp.json(), indent=4))
+    run_on_targets(args, resolve_vms(args, session),
+                   lambda vm: session.delete('/resources/vm/purge', json={"orka_vm_name": vm}))
+
+def resolve_vms(args, session, deployed_only=False):
+    '''
+    Expand the glob patterns of --vm, or the --tag pattern, into VM names. VMs are only listed if required.
+    With deployed_only, patterns only match VMs having deployed instances, e.g. to delete them
+    '''
+    patterns = [vm for vm in args.vm or () if is_pattern(vm)]
+    vm_names = [vm for vm in args.vm or () if not is_pattern(vm)]
+    if patterns or args.tag:
+        resp = check_http_status(session.get('/resources/vm/list/all'))
+        for vm in resp.json()["virtual_machine_resources"]:
+            if deployed_only and not vm.get('status'):
+                continue
+            tags = {vm.get('tag')} | {status.get('tag') for status in vm.get('status', ())}
+            if any(fnmatch(vm['virtual_machine_name'], pattern) for pattern in patterns) \
+                    or (args.tag and any(tag and fnmatch(tag, args.tag) for tag in tags)):
+                vm_names.append(vm['virtual_machine_name'])
+    return list(dict.fromkeys(vm_names))
+
+def is_pattern(name):
+    return any(char in name for char in '*?[')
+
+def run_on_targets(args, targets, send_request):
+    '''
+    Send a request for each target through a pool of --concurrency threads sharing the session,
+    report the outcome for each of them and exit with a non-zero code if any failed.
+    Return the JSON response bodies by target.
+    '''
+    if not targets:
+        print("No target matching")
+        sys.exit(1)
+    if len(targets) == 1:  # Same output as when a single target was supported
+        body = check_http_status(send_request(targets[0])).json()
+        print(json.dumps(body, indent=4))
+        return {targets[0]: body}
+    failures, bodies = 0, {}
+    for target, resp, error, duration in run_concurrently(lambda target: check_http_status(send_request(target)), targets, args.concurrency):
+        if error:
+            failures += 1
+            print(f"{target}: FAILED in {duration:.1f}s - {error}")
+        else:
+            bodies[target] = resp.json()
+            print(f"{target}: OK in {duration:.1f}s - {json.dumps(bodies[target])}")
+    print(f"{len(targets) - failures}/{len(targets)} succeeded")
+    if failures:
+        sys.exit(1)
+    return bodies
 
 
-def image_list(_, session):
+def image_list(args, session):
     resp = check_http_status(session.get('/resources/image/list'))
     images = resp.json()["image_attributes"]
+    if args.output != 'table':
+        write_rows(args, images)
+        return
     if images:
         print("             image             │ image_size │         modified         │        date_added        │ owner")
     for img in images:
@@ -153,25 +337,105 @@ def image_rename(args, session):
     print(json.dumps(resp.json(), indent=4))
 
 def image_delete(args, session):
-    resp = check_http_status(session.post('/resources/image/delete', json={"image": args.image}))
-    print(json.dumps(resp.json(), indent=4))
+    images = [image for image in args.image if not is_pattern(image)]
+    patterns = [image for image in args.image if is_pattern(image)]
+    if patterns:
+        resp = check_http_status(session.get('/resources/image/list'))
+        images.extend(img['image'] for img in resp.json()["image_attributes"]
+                      if any(fnmatch(img['image'], pattern) for pattern in patterns))
+    run_on_targets(args, list(dict.fromkeys(images)),
+                   lambda image: session.post('/resources/image/delete', json={"image": image}))
 
 
-def node_list(_, session):
+def node_list(args, session):
     resp = check_http_status(session.get('/resources/node/list'))
     nodes = resp.json()["nodes"]
+    if args.output != 'table':
+        write_rows(args, nodes)
+        return
     if nodes:
         print("   Node    │      IP       │  CPU  │ Memory │ State")
     for node in nodes:
         print(f"{node['name']:<10} | {node['address']} │ {node['available_cpu']:>2}/{node['allocatable_cpu']} | {node['available_memory']:<6} | {node['state']}")
 
-def node_status(args, session):
-    resp = check_http_status(session.get(f'/resources/node/status/{args.node}'))
-    print(json.dumps(resp.json(), indent=4))
+def node_capacity(args, session):
+    nodes = list_nodes(session)
+    print("vCPU │ Free slots │ Nodes")
+    for cpu in args.sizes:
+        free_slots = {node['name']: node_free_slots(node, cpu, args.memory and args.memory * cpu, args.tag) for node in nodes}
+        print(f"{cpu:>4} | {sum(free_slots.values()):>10} | " + ' '.join(f'{name}:{slots}' for name, slots in free_slots.items() if slots))
+
+def list_nodes(session, no_cache=False):
+    resp = check_http_status(session.get('/resources/node/list', headers={'Cache-Control': 'no-cache'} if no_cache else None))
+    return resp.json()["nodes"]
+
+def node_free_slots(node, cpu, memory=None, required_tag=None):
+    'Return how many VMs requiring this number of CPU & this memory in GB a node can currently fit'
+    if node.get('state', 'READY') != 'READY' or (required_tag and required_tag not in (node.get('orka_tags') or ())):
+        return 0
+    slots = int(node['available_cpu']) // cpu
+    if memory:
+        slots = min(slots, math.floor(parse_memory_in_gb(node['available_memory']) / memory))
+    return slots
+
+def parse_memory_in_gb(memory):
+    match = re.match(r'([\d.]+)\s*([KMGT]?)', str(memory), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Unexpected memory format: {memory}")
+    return float(match.group(1)) * {'K': 1e-6, 'M': 1e-3, '': 1, 'G': 1, 'T': 1e3}[match.group(2).upper()]
 
+def node_status(args, session):
+    if not args.all:
+        resp = check_http_status(session.get(f'/resources/node/status/{args.node}'))
+        print(json.dumps(resp.json(), indent=4))
+        return
+    nodes = [node['name'] for node in check_http_status(session.get('/resources/node/list')).json()["nodes"]]
+    nodes_status, failures = {}, 0
+    for node, resp, error, _ in run_concurrently(lambda node: check_http_status(session.get(f'/resources/node/status/{node}')), nodes, args.concurrency):
+        if error:
+            failures += 1
+            print(f"{node}: FAILED - {error}", file=sys.stderr)
+        else:
+            nodes_status[node] = resp.json()
+    # Listed in the order of the nodes list, rather than of completion:
+    print_nodes_status(args, {node: nodes_status[node] for node in nodes if node in nodes_status})
+    if failures:
+        sys.exit(1)
 
-def user_list(_, session):
+def print_nodes_status(args, nodes_status):
+    if args.output == 'json' and not args.fields:
+        print(json.dumps(nodes_status, indent=4))
+        return
+    rows = {node: dict(flatten_fields(status)) for node, status in nodes_status.items()}
+    if args.output != 'table':
+        write_rows(args, ({"node": node, **row} for node, row in rows.items()))
+        return
+    columns = list(dict.fromkeys(column for row in rows.values() for column in row if column not in ('message', 'help', 'errors')))
+    widths = [max([len(column)] + [len(str(row.get(column, ''))) for row in rows.values()]) for column in columns]
+    node_width = max([4] + [len(node) for node in rows])
+    print(f"{'Node':<{node_width}} │ " + ' │ '.join(f'{column:<{width}}' for column, width in zip(columns, widths)))
+    for node, row in rows.items():
+        print(f"{node:<{node_width}} | " + ' | '.join(f"{str(row.get(column, '')):<{width}}" for column, width in zip(columns, widths)))
+
+def write_rows(args, rows):
+    with RowsWriter(args.output, args.fields) as writer:
+        for row in rows:
+            writer.write(row)
+
+def flatten_fields(data, prefix=''):
+    'Yield (dotted.key, value) pairs for all the scalar values of a JSON object'
+    for key, value in data.items():
+        if isinstance(value, dict):
+            yield from flatten_fields(value, f'{prefix}{key}.')
+        elif not isinstance(value, list):
+            yield prefix + key, value
+
+
+def user_list(args, session):
     resp = check_http_status(session.get('/users'))
+    if args.output != 'table':
+        write_rows(args, ({"group": group, "email": user} for group, users in resp.json()["user_groups"].items() for user in users))
+        return
     for group, users in resp.json()["user_groups"].items():
         print(group)
         for user in users:
@@ -190,18 +454,133 @@ def user_delete(args, session):
     print(json.dumps(resp.json(), indent=4))
 
 
+def batch(args, session):
+    """
+    Run the commands read from --file through the same session, i.e. with a single login & kept-alive connections,
+    and write on stdout a JSON line per command, with its exit code & outputs, as they complete.
+    """
+    cmd_parser = batch_cmd_parser()
+    stdout, stderr = sys.stdout, sys.stderr
+    captured_stdout, captured_stderr = CapturableOutput(stdout), CapturableOutput(stderr)
+    sys.stdout, sys.stderr = captured_stdout, captured_stderr
+    def run_cmd(cmd):
+        line_number, line = cmd
+        start = time.monotonic()
+        with captured_stdout.capture() as out, captured_stderr.capture() as err:
+            exit_code = run_batch_cmd(cmd_parser, args, session, line)
+            return {"line": line_number, "command": line, "exit_code": exit_code, "duration": round(time.monotonic() - start, 3),
+                    "stdout": out.getvalue(), "stderr": err.getvalue()}
+    failures = 0
+    try:
+        with nullcontext(sys.stdin) if args.file == '-' else open(args.file, encoding='utf-8') as batch_file:
+            cmds = read_batch_cmds(batch_file)
+            if args.parallel > 1:
+                results = (result for _, result, _, _ in run_concurrently(run_cmd, cmds, args.parallel))
+            else:  # Commands are run as soon as they are read
+                results = map(run_cmd, cmds)
+            for result in results:
+                failures += result["exit_code"] != 0
+                print(json.dumps(result), file=stdout, flush=True)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    if failures:
+        sys.exit(1)
+
+def read_batch_cmds(batch_file):
+    'Yield (line number, line) for each command, skipping blank lines & comments'
+    for line_number, line in enumerate(batch_file, 1):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line_number, line
+
+def run_batch_cmd(cmd_parser, args, session, line):
+    'Run a command given either as a shell-like command line or as a JSON array of arguments, and return its exit code'
+    # The global options of the batch command are the defaults of all commands:
+    defaults = argparse.Namespace(**{key: value for key, value in vars(args).items() if key != 'func'})
+    try:
+        cmd_args = cmd_parser.parse_args(json.loads(line) if line.startswith('[') else shlex.split(line), namespace=defaults)
+        check_cmd_args(cmd_parser, cmd_args)
+        cmd_args.func(cmd_args, session)
+    except SystemExit as error:
+        return error.code if isinstance(error.code, int) else int(error.code is not None)
+    except Exception as error:  # pylint: disable=broad-except
+        print(f"{type(error).__name__}: {error}", file=sys.stderr)
+        return 1
+    return 0
+
+def batch_cmd_parser():
+    parser = argparse.ArgumentParser(prog='orka.py batch', formatter_class=ArgparseHelpFormatter, allow_abbrev=False)
+    add_output_opts(parser)
+    add_cmds_groups(parser.add_subparsers(required=True), CMDS_GROUPS)
+    return parser
+
+class CapturableOutput:
+    '''
+    Stand-in for sys.stdout or sys.stderr, writing into a buffer specific to the current context while capture() is active.
+    Threads started through run_concurrently inherit the context, and thus write into the same buffer
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = contextvars.ContextVar('buffer', default=None)
+
+    def __getattr__(self, name):
+        return getattr(self.buffer.get() or self.stream, name)
+
+    @contextmanager
+    def capture(self):
+        buffer = io.StringIO()
+        token = self.buffer.set(buffer)
+        try:
+            yield buffer
+        finally:
+            self.buffer.reset(token)
+
+
 def parse_args(argv=None):
-    # pylint: disable=too-many-statements
     parser = argparse.ArgumentParser(formatter_class=ArgparseHelpFormatter,
                                      description=__doc__, allow_abbrev=False)
     parser.add_argument('--retries', type=int, default=3, help='Max HTTP retries')
     parser.add_argument('--backoff-factor', type=float, default=.3, help='Backup factor for HTTP retries')
+    parser.add_argument('--concurrency', type=int, default=8, help='Max concurrent HTTP requests, for commands targeting several resources')
+    add_output_opts(parser)
     subparsers = parser.add_subparsers(required=True)
-
-    vm_cmd = subparsers.add_parser('vm')
-    vm_subparsers = vm_cmd.add_subparsers(dest='vm', required=True)
+    # Only the sub-commands of the selected group are defined, as building the whole parser tree slows down startup.
+    # If the group cannot be determined unambiguously from the command line, e.g. with an option value like --fields vm, all are defined:
+    selected_groups = {arg for arg in argv or () if arg in CMDS_GROUPS or arg == 'batch'}
+    add_cmds_groups(subparsers, selected_groups if len(selected_groups) == 1 else CMDS_GROUPS)
+    batch_cmd = subparsers.add_parser('batch', help='Run several commands through a single session, writing a JSON result per command')
+    batch_cmd.set_defaults(func=batch)
+    batch_cmd.add_argument('--file', '-f', default='-',
+                           help='File listing the commands to run, one per line, either as a shell-like command line like "vm get id --vm $vm" '
+                                'or as a JSON array of arguments. Use - to read from stdin')
+    batch_cmd.add_argument('--parallel', '-p', type=int, default=1, help='Max number of commands run concurrently, that must then be independent')
+    args = add_common_opts_and_parse_args(parser, argv)
+    check_cmd_args(parser, args)
+    if args.func is batch:  # Enough kept-alive connections for all concurrent commands:
+        args.concurrency = max(args.concurrency, args.parallel)
+    return args
+
+
+def check_cmd_args(parser, args):
+    'Check the constraints between the options of a command that argparse cannot express'
+    if getattr(args, 'changes_only', False) and not args.snapshot:
+        parser.error('--changes-only requires --snapshot')
+
+
+def add_cmds_groups(subparsers, selected_groups):
+    for group, add_group_cmds in CMDS_GROUPS.items():
+        group_cmd = subparsers.add_parser(group)
+        if group in selected_groups:
+            add_group_cmds(group_cmd)
+
+
+def add_vm_cmds(group_cmd):
+    vm_subparsers = group_cmd.add_subparsers(dest='vm', required=True)
     vm_list_cmd = vm_subparsers.add_parser('list')
     vm_list_cmd.set_defaults(func=vm_list)
+    vm_list_cmd.add_argument('--snapshot', help='File where the VMs deployed are saved, to compare them to the ones of the previous call')
+    vm_list_cmd.add_argument('--changes-only', action='store_true',
+                             help='Only list the VMs created, deleted, redeployed or moved to another node since the previous call. Requires --snapshot')
     vm_status_cmd = vm_subparsers.add_parser('status')
     vm_status_cmd.set_defaults(func=vm_status)
     vm_status_cmd.add_argument('--vm', '-v', required=True)
@@ -219,25 +598,30 @@ def parse_args(argv=None):
     vm_create_config_cmd.add_argument('--tag_required', '-T', action='store_true')
     vm_deploy_cmd = vm_subparsers.add_parser('deploy')
     vm_deploy_cmd.set_defaults(func=vm_deploy)
-    vm_deploy_cmd.add_argument('--vm', '-v', required=True)
+    add_vm_targets_args(vm_deploy_cmd)
+    add_wait_args(vm_deploy_cmd)
+    add_capacity_args(vm_deploy_cmd)
     vm_create_cmd = vm_subparsers.add_parser('create')
     vm_create_cmd.set_defaults(func=vm_create)
     vm_create_cmd.add_argument('--vm', '-v', required=True)
     vm_create_cmd.add_argument('--base-image', '-b', required=True)
     vm_create_cmd.add_argument('--cpu', '-c', type=int, required=True)
     vm_create_cmd.add_argument('--vcpu', '-C', type=int, required=True)
+    add_wait_args(vm_create_cmd)
+    add_capacity_args(vm_create_cmd)
     vm_suspend_cmd = vm_subparsers.add_parser('suspend')
     vm_suspend_cmd.set_defaults(func=vm_suspend)
     vm_suspend_cmd.add_argument('--vm', '-v', required=True)
     vm_delete_cmd = vm_subparsers.add_parser('delete')
     vm_delete_cmd.set_defaults(func=vm_delete)
-    vm_delete_cmd.add_argument('--vm', '-v', required=True)
+    add_vm_targets_args(vm_delete_cmd)
     vm_purge_cmd = vm_subparsers.add_parser('purge')
     vm_purge_cmd.set_defaults(func=vm_purge)
-    vm_purge_cmd.add_argument('--vm', '-v', required=True)
+    add_vm_targets_args(vm_purge_cmd)
 
-    img_cmd = subparsers.add_parser('image')
-    img_subparsers = img_cmd.add_subparsers(dest='image', required=True)
+
+def add_image_cmds(group_cmd):
+    img_subparsers = group_cmd.add_subparsers(dest='image', required=True)
     img_list_cmd = img_subparsers.add_parser('list')
     img_list_cmd.set_defaults(func=image_list)
     img_save_cmd = img_subparsers.add_parser('save')
@@ -246,7 +630,7 @@ def parse_args(argv=None):
     img_save_cmd.add_argument('--new-base-image-name', '-b', required=True)
     img_delete_cmd = img_subparsers.add_parser('delete')
     img_delete_cmd.set_defaults(func=image_delete)
-    img_delete_cmd.add_argument('-i', '--image', required=True)
+    img_delete_cmd.add_argument('-i', '--image', nargs='+', required=True, help='Image names or glob patterns')
     img_commit_cmd = img_subparsers.add_parser('commit')
     img_commit_cmd.set_defaults(func=image_commit)
     img_commit_cmd.add_argument('--vm-id', '--vm', '-v', required=True)
@@ -255,16 +639,25 @@ def parse_args(argv=None):
     img_rename_cmd.add_argument('-i', '--image', required=True)
     img_rename_cmd.add_argument('-o', required=True)
 
-    node_cmd = subparsers.add_parser('node')
-    node_subparsers = node_cmd.add_subparsers(dest='node', required=True)
+
+def add_node_cmds(group_cmd):
+    node_subparsers = group_cmd.add_subparsers(dest='node', required=True)
     node_list_cmd = node_subparsers.add_parser('list')
     node_list_cmd.set_defaults(func=node_list)
     node_status_cmd = node_subparsers.add_parser('status')
     node_status_cmd.set_defaults(func=node_status)
-    node_status_cmd.add_argument('--node', '-n', required=True)
-
-    user_cmd = subparsers.add_parser('user')
-    user_subparsers = user_cmd.add_subparsers(dest='user', required=True)
+    node_status_targets = node_status_cmd.add_mutually_exclusive_group(required=True)
+    node_status_targets.add_argument('--node', '-n')
+    node_status_targets.add_argument('--all', '-a', action='store_true', help='Concurrently retrieve the status of all nodes')
+    node_capacity_cmd = node_subparsers.add_parser('capacity', help='Report how many VMs of each size the cluster can currently fit')
+    node_capacity_cmd.set_defaults(func=node_capacity)
+    node_capacity_cmd.add_argument('--sizes', '-s', type=int, nargs='+', default=[3, 4, 6, 8, 12], help='Numbers of CPU per VM')
+    node_capacity_cmd.add_argument('--memory', '-m', type=float, help='Memory in GB required per CPU of the VMs')
+    node_capacity_cmd.add_argument('--tag', '-t', help='Only consider nodes with this tag')
+
+
+def add_user_cmds(group_cmd):
+    user_subparsers = group_cmd.add_subparsers(dest='user', required=True)
     user_list_cmd = user_subparsers.add_parser('list')
     user_list_cmd.set_defaults(func=user_list)
     user_create_cmd = user_subparsers.add_parser('create')
@@ -275,7 +668,27 @@ def parse_args(argv=None):
     user_delete_cmd.add_argument('-e', dest='email', required=True)
     user_delete_cmd.set_defaults(func=user_delete)
 
-    return add_common_opts_and_parse_args(parser, argv)
+
+
+CMDS_GROUPS = {'vm': add_vm_cmds, 'image': add_image_cmds, 'node': add_node_cmds, 'user': add_user_cmds}
+
+
+def add_wait_args(cmd):
+    cmd.add_argument('--wait', '-w', action='store_true', help='Wait for VMs to be running & reachable through SSH')
+    cmd.add_argument('--wait-timeout', type=float, default=600, help='Max number of seconds to wait for')
+
+
+def add_capacity_args(cmd):
+    cmd.add_argument('--check-capacity', action='store_true', help='Fail without deploying if no node can currently fit the VM')
+    cmd.add_argument('--wait-for-capacity', action='store_true', help='Wait until a node can fit the VM before deploying it')
+    cmd.add_argument('--capacity-timeout', type=float, default=3600, help='Max number of seconds to wait for capacity')
+    cmd.add_argument('--memory', '-m', type=float, help='Memory in GB required per CPU of the VM, checked along with its CPU')
+
+
+def add_vm_targets_args(cmd):
+    targets = cmd.add_mutually_exclusive_group(required=True)
+    targets.add_argument('--vm', '-v', nargs='+', help='VM names or glob patterns')
+    targets.add_argument('--tag', '-t', help='Glob pattern matching the tag of VMs')
 
 
 if __name__ == '__main__':
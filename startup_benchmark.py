@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Measure the startup time of orka.py commands, i.e. the time spent importing modules & parsing the command line,
+by running them with --help: the median wall time of several runs is reported,
+along with the import time breakdown from python -X importtime of the run with the median total import time.
+
+It can be used as a regression check, failing if the imports of a command take more than --max-import-ms,
+or if a module that should only be imported by the commands needing it is imported at startup.
+'''
+
+# USAGE: ./startup_benchmark.py
+#        ./startup_benchmark.py --runs 5 --max-import-ms 150
+
+import argparse, os, statistics, subprocess, sys, time
+
+
+COMMANDS = (
+    ('vm', 'list'),
+    ('vm', 'get'),
+    ('vm', 'deploy'),
+    ('image', 'list'),
+    ('node', 'status'),
+    ('user', 'list'),
+)
+# Modules only imported by the commands that need them:
+LAZY_MODULES = ('asyncio', 'commons_snapshot', 'commons_trace', 'gzip', 'logs_reader')
+ORKA_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'orka.py')
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    baseline_modules = set(import_times(['-c', 'pass']))
+    failures = []
+    for cmd in COMMANDS:
+        cmd_line = [ORKA_SCRIPT, *cmd, '--help']
+        wall_times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *cmd_line], check=True, stdout=subprocess.DEVNULL)
+            wall_times.append(time.perf_counter() - start)
+        # Only modules imported on top of the ones loaded by the interpreter startup are accounted for,
+        # & as import times are noisy, the run with the median total import time is kept:
+        runs_imports = sorted(({module: cumulative_us for module, cumulative_us in import_times(cmd_line).items() if module not in baseline_modules}
+                               for _ in range(args.runs)), key=lambda imports: sum(imports.values()))
+        imports = runs_imports[len(runs_imports) // 2]
+        total_ms = sum(imports.values()) / 1000
+        print(f"orka.py {' '.join(cmd)}: {statistics.median(wall_times) * 1000:.1f}ms, imports: {total_ms:.1f}ms (medians of {args.runs} runs)")
+        for module, cumulative_us in sorted(imports.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+            print(f'    {module:<24} {cumulative_us / 1000:6.1f}ms')
+        if args.max_import_ms and total_ms > args.max_import_ms:
+            failures.append(f"orka.py {' '.join(cmd)}: imports took {total_ms:.1f}ms > {args.max_import_ms}ms")
+        failures.extend(f"orka.py {' '.join(cmd)}: {module} imported at startup" for module in all_imported_modules(cmd_line) if module in LAZY_MODULES)
+    if failures:
+        print('\n'.join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+def import_times(python_args):
+    'Return the cumulative import times in microseconds of the top-level modules imported, from python -X importtime'
+    return {module: cumulative_us for module, cumulative_us, level in parse_importtime(python_args) if level == 0}
+
+
+def all_imported_modules(python_args):
+    return {module for module, _, _ in parse_importtime(python_args)}
+
+
+def parse_importtime(python_args):
+    'Yield (module, cumulative import time in microseconds, nesting level) tuples'
+    output = subprocess.run([sys.executable, '-X', 'importtime', *python_args], check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True).stderr
+    for line in output.splitlines():
+        # Lines format: "import time: {self_us:>9} | {cumulative_us:>10} | {'  ' * level}{module}"
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, module = line.split('|')
+        yield module.strip(), int(cumulative_us), (len(module) - len(module.lstrip()) - 1) // 2
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__, allow_abbrev=False)
+    parser.add_argument('--runs', type=int, default=10, help='Number of runs of each command to measure its wall time')
+    parser.add_argument('--top', type=int, default=5, help='Number of slowest modules to import to display per command')
+    parser.add_argument('--max-import-ms', type=float, help='Fail if the imports of a command take longer than that')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])